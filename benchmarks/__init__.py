@@ -0,0 +1,2 @@
+# Synthetic-estate benchmarks for tf_sastre.py import, create and vars
+#   python -m benchmarks.run --scales 1 10 100 --output bench_results.json
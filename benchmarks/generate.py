@@ -0,0 +1,177 @@
+import os, json, random, uuid, argparse
+
+# Synthetic sastre backup + matching terraform.tfstate
+#   <directory>/data/inventory/<sastre type>.json                index files
+#   <directory>/data/<type dirs>/<name>.json                     detail files
+#   <directory>/data/device_templates/values/<template>.json     device variables
+#   <directory>/terraform.tfstate
+
+# object counts at scale 1
+base_counts = {
+    "device_templates": 10,
+    "feature_templates": 100,
+    "policy_lists": 50,
+    "policy_definitions": 20,
+    "localized_policies": 5,
+    "devices_per_template": 20,
+}
+
+feature_template_types = ["cisco_system", "cisco_logging", "cisco_bfd", "cisco_vpn", "cisco_ntp"]
+
+# -------------------------------------------------------------------------------------------------
+class estate_generator:
+    def __init__ (self, directory, counts, seed=1):
+        self.directory = directory
+        self.counts = counts
+        self.random = random.Random (seed)
+        self.resources = []
+        self.inventory = {}
+
+    def new_id (self):
+        return str (uuid.UUID (int=self.random.getrandbits (128)))
+
+    def write_json (self, path, content):
+        path = os.path.join (self.directory, path)
+        os.makedirs (os.path.dirname (path), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump (content, file, indent=2)
+
+    def add_object (self, sastre_type, index_entry, detail_path, detail, tf_type, attributes):
+        self.inventory.setdefault (sastre_type, []).append (index_entry)
+        self.write_json (f"data/{detail_path}.json", detail)
+        self.resources.append ({"mode": "managed", "type": tf_type, "name": attributes["name"],
+                                "provider": 'provider["registry.terraform.io/ciscodevnet/sdwan"]',
+                                "instances": [{"schema_version": 0, "attributes": attributes, "sensitive_attributes": []}]})
+
+    # ---------------------------------------------------------------------------------------------
+    def policy_lists (self):
+        ids = []
+        for idx in range(self.counts["policy_lists"]):
+            id = self.new_id ()
+            name = f"SITES_{idx}"
+            entries = [{"site_id": str (self.random.randint (1, 9999))} for _ in range(self.random.randint (1, 10))]
+            self.add_object ("policy_lists_site", {"name": name, "listId": id, "type": "site"},
+                             f"policy_lists/site/{name}", {"listId": id, "name": name, "type": "site",
+                                                           "entries": [{"siteId": entry["site_id"]} for entry in entries]},
+                             "sdwan_site_list_policy_object", {"id": id, "name": name, "version": 0, "entries": entries})
+            ids.append (id)
+        return ids
+
+    def feature_templates (self, list_ids):
+        ids = []
+        for idx in range(self.counts["feature_templates"]):
+            id = self.new_id ()
+            template_type = self.random.choice (feature_template_types)
+            name = f"FT_{template_type}_{idx}"
+            list_id = self.random.choice (list_ids)
+            attributes = {"id": id, "name": name, "description": f"{template_type} template {idx}", "device_types": ["C8000V", "ISR4331"],
+                          "version": 1, "template_type": template_type, "timezone": "UTC", "enable": True, "hostname": None,
+                          "cli": "hostname edge\r\n!\nline vty 0 4\n",
+                          "trackers": [{"name": f"tracker{n}", "threshold": 300, "multiplier": None, "endpoint_ip": f"10.0.{n}.1",
+                                        "list_id": list_id, "options": [{"key": "a", "value": n}]} for n in range(3)]}
+            self.add_object ("feature_templates", {"templateName": name, "templateId": id, "templateType": template_type,
+                                                   "deviceType": ["vedge-C8000V", "vedge-ISR4331"]},
+                             f"feature_templates/{name}", {"templateId": id, "templateName": name, "templateType": template_type,
+                                                           "templateDefinition": {"tracker": {"list": list_id}}},
+                             f"sdwan_{template_type}_feature_template", attributes)
+            ids.append ((id, template_type))
+        return ids
+
+    def policy_definitions (self, list_ids):
+        ids = []
+        for idx in range(self.counts["policy_definitions"]):
+            id = self.new_id ()
+            name = f"AAR_{idx}"
+            list_id = self.random.choice (list_ids)
+            sequences = [{"id": n, "name": f"seq{n}", "match_entries": [{"type": "siteList", "site_list_id": list_id}],
+                          "action_entries": [{"type": "slaClassList", "sla_class_parameters": [{"type": "preferredColor", "preferred_color": "mpls"}]}]}
+                         for n in range(self.random.randint (1, 5))]
+            self.add_object ("policy_definitions_approute", {"name": name, "definitionId": id, "type": "appRoute"},
+                             f"policy_definitions/approute/{name}", {"definitionId": id, "name": name, "type": "appRoute",
+                                                                     "sequences": [{"match": {"entries": [{"ref": list_id}]}}]},
+                             "sdwan_application_aware_routing_policy_definition",
+                             {"id": id, "name": name, "description": "AAR", "version": 0, "sequences": sequences})
+            ids.append (id)
+        return ids
+
+    def localized_policies (self, definition_ids):
+        ids = []
+        for idx in range(self.counts["localized_policies"]):
+            id = self.new_id ()
+            name = f"LP_{idx}"
+            definitions = self.random.sample (definition_ids, min (3, len (definition_ids)))
+            self.add_object ("policy_templates_vedge", {"policyName": name, "policyId": id, "policyType": "feature"},
+                             f"policy_templates/vedge/{name}", {"policyId": id, "policyName": name,
+                                                                "policyDefinition": {"assembly": [{"definitionId": d} for d in definitions]}},
+                             "sdwan_localized_policy", {"id": id, "name": name, "description": "LP", "version": 0, "flow_visibility_ipv4": True,
+                                                        "definitions": [{"id": d, "type": "appRoute", "version": 0} for d in definitions]})
+            ids.append (id)
+        return ids
+
+    def device_templates (self, feature_template_ids, policy_ids):
+        for idx in range(self.counts["device_templates"]):
+            id = self.new_id ()
+            name = f"DT_{idx}"
+            policy_id = self.random.choice (policy_ids)
+            templates = self.random.sample (feature_template_ids, min (5, len (feature_template_ids)))
+            general_templates = [{"id": ft_id, "type": ft_type, "version": 1, "sub_templates": None} for ft_id, ft_type in templates]
+            self.add_object ("device_templates", {"templateName": name, "templateId": id, "deviceType": "vedge-C8000V", "configType": "template"},
+                             f"device_templates/template/{name}", {"templateId": id, "templateName": name, "policyId": policy_id,
+                                                                   "generalTemplates": [{"templateId": ft_id} for ft_id, ft_type in templates]},
+                             "sdwan_feature_device_template",
+                             {"id": id, "name": name, "description": "DT", "device_type": "vedge-C8000V", "device_role": "sdwan-edge",
+                              "version": 2, "policy_id": policy_id, "policy_version": 0, "general_templates": general_templates})
+            self.device_values (name)
+
+    def device_values (self, template_name):
+        columns = [{"property": "csv-status", "title": "Status"}, {"property": "csv-deviceId", "title": "Chassis Number"},
+                   {"property": "csv-deviceIP", "title": "System IP"}, {"property": "csv-host-name", "title": "Hostname"},
+                   {"property": "//system/host-name", "title": "Hostname(system_host_name)"},
+                   {"property": "//system/system-ip", "title": "System IP(system_system_ip)"},
+                   {"property": "//system/site-id", "title": "Site ID(system_site_id)"},
+                   {"property": "/0/vpn_if/interface/ip/address", "title": "IPv4 Address(vpn if ip)"}]
+        data = []
+        for idx in range(self.counts["devices_per_template"]):
+            device_id = f"C8K-{self.new_id ()}"
+            system_ip = f"10.{idx // 250}.{idx % 250}.1"
+            data.append ({"csv-status": "complete", "csv-deviceId": device_id, "csv-deviceIP": system_ip, "csv-host-name": f"{template_name}-{idx}",
+                          "//system/host-name": f"{template_name}-{idx}", "//system/system-ip": system_ip, "//system/site-id": str (idx),
+                          "/0/vpn_if/interface/ip/address": f"192.168.{idx % 250}.1/24"})
+        self.write_json (f"data/device_templates/values/{template_name}.json", {"header": {"columns": columns}, "data": data})
+
+    # ---------------------------------------------------------------------------------------------
+    def generate (self):
+        list_ids = self.policy_lists ()
+        feature_template_ids = self.feature_templates (list_ids)
+        definition_ids = self.policy_definitions (list_ids)
+        policy_ids = self.localized_policies (definition_ids)
+        self.device_templates (feature_template_ids, policy_ids)
+
+        for sastre_type, entries in self.inventory.items():
+            self.write_json (f"data/inventory/{sastre_type}.json", entries)
+
+        self.write_json ("terraform.tfstate", {"version": 4, "terraform_version": "1.6.0", "serial": 1, "lineage": self.new_id (),
+                                               "outputs": {}, "resources": self.resources, "check_results": None})
+
+# -------------------------------------------------------------------------------------------------
+def scaled_counts (scale):
+    counts = {key: max (1, int (value * scale)) for key, value in base_counts.items()}
+    # more device templates, not bigger ones
+    counts["devices_per_template"] = base_counts["devices_per_template"]
+    return counts
+
+def generate_estate (directory, scale=1, seed=1):
+    estate_generator (directory, scaled_counts (scale), seed).generate ()
+
+# ==============================================================================================
+def main():
+    parser = argparse.ArgumentParser (description="Generate a synthetic sastre backup and terraform.tfstate")
+    parser.add_argument ('directory', help="Target directory")
+    parser.add_argument ('-s', '--scale', type=float, default = 1, help="Multiplier for the object counts")
+    parser.add_argument ('--seed', type=int, default = 1, help="Random seed")
+    args = parser.parse_args()
+
+    generate_estate (args.directory, args.scale, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import os, sys, json, time, queue, logging, argparse, resource, tempfile, shutil
+import multiprocessing
+
+from benchmarks.generate import generate_estate, scaled_counts
+
+# Each benchmark runs in a fresh process so that peak RSS belongs to that case only
+case_timeout = 3600     # seconds
+
+# -------------------------------------------------------------------------------------------------
+def case_import (estate_dir, output_dir):
+    import tf_sastre
+    (import_items, inventory_ids) = tf_sastre.load_json_directory (f"{estate_dir}data/inventory")
+    tf_sastre.write_import_files (import_items, output_dir, "script")
+
+def case_create (estate_dir, output_dir):
+    import tf_sastre
+    tf_sastre.terraform_create (estate_dir, output_dir)
+
+def case_create_streaming (estate_dir, output_dir):
+    import tf_sastre
+    tf_sastre.terraform_create (estate_dir, output_dir, streaming=True)
+
+def case_vars (estate_dir, output_dir):
+    import tf_sastre
+    tf_sastre.terraform_variables (f"{estate_dir}data/", output_dir, False)
+
+cases = {
+    "import": case_import,
+    "create": case_create,
+    "create_streaming": case_create_streaming,
+    "vars": case_vars,
+}
+
+# -------------------------------------------------------------------------------------------------
+def directory_size (directory):
+    return sum (os.path.getsize (os.path.join (dirpath, fname)) for dirpath, dirnames, fnames in os.walk (directory) for fname in fnames)
+
+def peak_rss_kb ():
+    """ ru_maxrss is in KiB on Linux, in bytes on macOS """
+
+    peak = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def run_case (case, estate_dir, output_dir, results):
+    logging.basicConfig (level=logging.WARNING)
+    wall = time.perf_counter ()
+    cpu = time.process_time ()
+    cases[case] (estate_dir, output_dir)
+    results.put ({"wall_s": round (time.perf_counter () - wall, 4),
+                "cpu_s": round (time.process_time () - cpu, 4),
+                "peak_rss_kb": peak_rss_kb ()})
+
+def measure (case, estate_dir, work_dir, timeout=case_timeout):
+    """ Returns the case measurements, or {"error"} if the case failed (exit code) or timed out """
+
+    output_dir = os.path.join (work_dir, f"out-{case}") + "/"
+    os.makedirs (output_dir, exist_ok=True)
+
+    context = multiprocessing.get_context ("spawn")
+    results = context.Queue ()
+    process = context.Process (target=run_case, args=(case, estate_dir, output_dir, results))
+    process.start ()
+
+    # a case that raises never puts its result
+    result = None
+    deadline = time.monotonic () + timeout
+    while result is None and time.monotonic () < deadline:
+        try:
+            result = results.get (timeout=1)
+        except queue.Empty:
+            if not process.is_alive ():
+                # the result may have arrived just before the exit
+                try:
+                    result = results.get (timeout=1)
+                except queue.Empty:
+                    pass
+                break
+    timed_out = result is None and process.is_alive ()
+    if timed_out:
+        process.terminate ()
+    process.join ()
+
+    if timed_out:
+        return {"error": f"timed out after {timeout}s"}
+    if result is None or process.exitcode != 0:
+        return {"error": f"exit code {process.exitcode}"}
+
+    result["output_bytes"] = directory_size (output_dir)
+    return result
+
+# ==============================================================================================
+def main():
+    parser = argparse.ArgumentParser (description="Benchmark tf_sastre.py on synthetic sastre estates")
+    parser.add_argument ('--scales', type=float, nargs='+', default = [1, 10, 100], help="Estate scales to run")
+    parser.add_argument ('--cases', nargs='+', choices=list (cases.keys()), default = list (cases.keys()), help="Benchmarks to run")
+    parser.add_argument ('-o', '--output', default = "bench_results.json", help="JSON results file")
+    parser.add_argument ('--timeout', type=float, default = case_timeout, help="Seconds before a case is stopped and reported as failed")
+    parser.add_argument ('--keep', action='store_true', help="Keep the generated estates and outputs")
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        work_dir = tempfile.mkdtemp (prefix=f"sdwan-bench-{scale}x-")
+        estate_dir = os.path.join (work_dir, "estate") + "/"
+        generate_estate (estate_dir, scale)
+        estate = {"scale": scale, "counts": scaled_counts (scale), "tfstate_bytes": os.path.getsize (f"{estate_dir}terraform.tfstate")}
+
+        for case in args.cases:
+            result = {"case": case, **estate, **measure (case, estate_dir, work_dir, args.timeout)}
+            if "error" in result:
+                print (f"{case:>18} {scale:>6}x: failed, {result['error']}")
+                results.append (result)
+                continue
+            print (f"{case:>18} {scale:>6}x: {result['wall_s']:>9.3f}s wall, {result['peak_rss_kb'] // 1024:>6} MB peak RSS, "
+                   f"{result['output_bytes']:>12} bytes output")
+            results.append (result)
+
+        if not args.keep:
+            shutil.rmtree (work_dir)
+
+    with open(args.output, "w") as file:
+        json.dump ({"python": sys.version.split()[0], "timestamp": time.strftime ("%Y-%m-%dT%H:%M:%S"), "results": results}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import os, sys, json, time, shutil, tempfile, threading, unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+import tf_api
+
+# Local mock vManage: login with session cookie and XSRF token, paginated lists (2 items per page),
+# a connection dropped once without answer and an endpoint slower than the client timeout
+mock_items = [{"listId": f"id-{idx}", "name": f"list_{idx}"} for idx in range(5)]
+
+class mock_vmanage (BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = []
+    dropped = set()
+
+    def log_message (self, *args):
+        pass
+
+    def send (self, status, body, headers={}):
+        content = body if type (body) == bytes else json.dumps (body).encode()
+        self.send_response (status)
+        self.send_header ("Content-Length", str (len (content)))
+        for key, value in headers.items():
+            self.send_header (key, value)
+        self.end_headers ()
+        self.wfile.write (content)
+
+    def do_POST (self):
+        body = self.rfile.read (int (self.headers.get ("Content-Length", 0))).decode()
+        if self.path == "/j_security_check":
+            if "j_password=secret" not in body:
+                return self.send (200, b"<html>login</html>")
+            return self.send (200, b"", {"Set-Cookie": "JSESSIONID=abc; Path=/"})
+        self.send (404, {})
+
+    def do_GET (self):
+        mock_vmanage.requests.append (self.path)
+        if self.path == "/dataservice/client/token":
+            return self.send (200, b"token")
+        if self.headers.get ("Cookie") != "JSESSIONID=abc" or self.headers.get ("X-XSRF-TOKEN") != "token":
+            return self.send (403, {})
+
+        (path, _, query) = self.path.partition ("?")
+        params = dict (item.split ("=") for item in query.split ("&")) if query else {}
+        if path == "/dataservice/template/policy/list/site":
+            start = int (params.get ("startId", 0))
+            return self.send (200, {"data": mock_items[start:start + 2],
+                                    "pageInfo": {"moreEntries": start + 2 < len (mock_items), "endId": start + 2}})
+        if path == "/dataservice/flaky" and path not in mock_vmanage.dropped:
+            mock_vmanage.dropped.add (path)
+            self.close_connection = True
+            return
+        if path == "/dataservice/flaky":
+            return self.send (200, [{"ok": True}])
+        if path == "/dataservice/slow":
+            time.sleep (1)
+            return self.send (200, [])
+        self.send (404, {})
+
+# -------------------------------------------------------------------------------------------------
+class test_vmanage_client (unittest.TestCase):
+    @classmethod
+    def setUpClass (cls):
+        cls.server = ThreadingHTTPServer (("127.0.0.1", 0), mock_vmanage)
+        cls.server.daemon_threads = True
+        threading.Thread (target=cls.server.serve_forever, daemon=True).start ()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass (cls):
+        cls.server.shutdown ()
+        cls.server.server_close ()
+
+    def setUp (self):
+        mock_vmanage.requests = []
+        mock_vmanage.dropped = set()
+        self.client = tf_api.vmanage_client (self.url, "admin", "secret")
+
+    def test_login (self):
+        self.assertEqual (self.client.headers["Cookie"], "JSESSIONID=abc")
+        self.assertEqual (self.client.headers["X-XSRF-TOKEN"], "token")
+
+    def test_login_failure (self):
+        with self.assertRaises (SystemExit):
+            tf_api.vmanage_client (self.url, "admin", "wrong")
+
+    def test_pagination (self):
+        items = self.client.get_data ("/template/policy/list/site")
+        self.assertEqual (items, mock_items)
+        pages = [path for path in mock_vmanage.requests if path.startswith ("/dataservice/template/policy/list/site")]
+        self.assertEqual (len (pages), 3)
+        self.assertTrue (all (f"count={tf_api.page_size}" in path for path in pages))
+
+    def test_reconnect (self):
+        self.assertEqual (self.client.get_data ("/flaky"), [{"ok": True}])
+        self.assertIn ("/dataservice/flaky", mock_vmanage.dropped)
+
+    def test_timeout (self):
+        timeout = tf_api.api_timeout
+        tf_api.api_timeout = 0.2
+        try:
+            client = tf_api.vmanage_client (self.url, "admin", "secret")
+            with self.assertRaises (SystemExit):
+                client.get ("/slow")
+        finally:
+            tf_api.api_timeout = timeout
+
+    def test_fetch_inventory (self):
+        source_dir = tempfile.mkdtemp ()
+        try:
+            tf_api.fetch_inventory (self.client, f"{source_dir}/", jobs=4)
+            with open(f"{source_dir}/inventory/policy_lists_site.json", "r") as content_file:
+                self.assertEqual (json.load (content_file), mock_items)
+            # 404 types are not saved
+            self.assertFalse (os.path.exists (f"{source_dir}/inventory/device_templates.json"))
+        finally:
+            shutil.rmtree (source_dir)
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,44 @@
+import os, sys, unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+import tf_executor
+
+# -------------------------------------------------------------------------------------------------
+class test_version_satisfies (unittest.TestCase):
+    def check (self, constraints, satisfied, not_satisfied):
+        for version in satisfied:
+            self.assertTrue (tf_executor.version_satisfies (version, constraints), f"{version} {constraints}")
+        for version in not_satisfied:
+            self.assertFalse (tf_executor.version_satisfies (version, constraints), f"{version} {constraints}")
+
+    def test_comparisons (self):
+        self.check (">= 0.3.13", ["0.3.13", "0.3.14", "0.4.0", "1.0.0"], ["0.3.12", "0.2.99"])
+        self.check ("> 0.3.13", ["0.3.14"], ["0.3.13"])
+        self.check ("< 1.0", ["0.99.99"], ["1.0.0", "1.0.1"])
+        self.check ("<= 1.0", ["1.0.0"], ["1.0.1"])
+        self.check ("= 1.2", ["1.2.0"], ["1.2.1"])
+        self.check ("1.2.3", ["1.2.3"], ["1.2.4"])
+
+    def test_not_equal (self):
+        self.check ("!= 0.3.14", ["0.3.13", "0.3.15"], ["0.3.14"])
+
+    def test_pessimistic (self):
+        # only the rightmost given part may increase
+        self.check ("~> 0.3.1", ["0.3.1", "0.3.9"], ["0.3.0", "0.4.0", "1.3.1"])
+        self.check ("~> 0.3", ["0.3.0", "0.9.1"], ["0.2.9", "1.0.0"])
+        self.check ("~> 1", ["1.0.0", "9.9.9"], ["0.9.9"])
+
+    def test_multiple (self):
+        self.check (">= 0.3, < 1.0, != 0.5.0", ["0.3.0", "0.5.1", "0.99.0"], ["0.2.9", "0.5.0", "1.0.0"])
+        self.check ("~> 0.3.1, != 0.3.4", ["0.3.3", "0.3.5"], ["0.3.4", "0.4.0"])
+
+    def test_version_formats (self):
+        self.check (">= 0.3.13", ["v0.3.13", "0.4.0-beta1"], ["0.3"])
+        self.check (">= v0.3", ["0.3.0"], [])
+
+    def test_invalid (self):
+        self.check (">>= 1.0", [], ["1.0.0"])
+        self.check ("", [], ["1.0.0"])
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,113 @@
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+import tf_library
+
+# -------------------------------------------------------------------------------------------------
+class test_remove_stale (unittest.TestCase):
+    def setUp (self):
+        self.work_dir = tempfile.mkdtemp ()
+        self.basename = os.path.join (self.work_dir, "sdwan-tf-import")
+        self.record = os.path.join (self.work_dir, "outputs.json")
+
+    def tearDown (self):
+        shutil.rmtree (self.work_dir)
+
+    def run_create (self, streams, layout="flat"):
+        texts = tf_library.text_handler (self.basename, layout)
+        for stream in streams:
+            texts.add (stream, "")
+        texts.write ()
+        return texts.remove_stale (self.record)
+
+    def test_flat (self):
+        self.run_create (["main", "policy_object", "feature_template"])
+        user_file = f"{self.basename}-custom.tf"
+        open(user_file, "w").close ()
+
+        removed = self.run_create (["main", "feature_template"])
+        self.assertEqual (removed, [f"{self.basename}-policy_object.tf"])
+        self.assertTrue (os.path.exists (user_file))
+        self.assertTrue (os.path.exists (f"{self.basename}-feature_template.tf"))
+
+    def test_streams_keep_tfstate (self):
+        self.run_create (["policy_object", "feature_template"], "streams")
+        state_file = os.path.join (self.work_dir, "policy_object", "terraform.tfstate")
+        open(state_file, "w").close ()
+
+        self.run_create (["feature_template"], "streams")
+        self.assertFalse (os.path.exists (os.path.join (self.work_dir, "policy_object", "sdwan-tf-import-policy_object.tf")))
+        self.assertTrue (os.path.exists (state_file))
+
+    def test_streams_remove_empty_module (self):
+        self.run_create (["policy_object", "feature_template"], "streams")
+        self.run_create (["feature_template"], "streams")
+        self.assertFalse (os.path.exists (os.path.join (self.work_dir, "policy_object")))
+
+    def test_first_run (self):
+        """ Without a record nothing is removed """
+
+        user_file = f"{self.basename}-custom.tf"
+        open(user_file, "w").close ()
+        self.assertEqual (self.run_create (["main"]), [])
+        self.assertTrue (os.path.exists (user_file))
+
+# -------------------------------------------------------------------------------------------------
+class test_render_manifest (unittest.TestCase):
+    settings = {"layout": "flat", "format": "hcl"}
+    facts = {"ref-1": ["sdwan_x.one", "x"]}
+
+    def setUp (self):
+        self.work_dir = tempfile.mkdtemp ()
+        self.filename = os.path.join (self.work_dir, "manifest.json")
+        manifest = tf_library.render_manifest (self.filename, self.settings)
+        manifest.store ("sdwan_x.a", "hash-a", 'resource "sdwan_x" "a" {\n  ü = 1\n}\n', self.facts, ["d1"])
+        manifest.store ("sdwan_x.b", "hash-b", 'resource "sdwan_x" "b" {}\n', {}, [])
+        manifest.write ()
+
+    def tearDown (self):
+        shutil.rmtree (self.work_dir)
+
+    def id_facts (self, id):
+        return self.facts.get (id)
+
+    def test_reuse (self):
+        manifest = tf_library.render_manifest (self.filename, self.settings)
+        entry = manifest.lookup ("sdwan_x.a", "hash-a", self.id_facts)
+        self.assertEqual (entry["text"], 'resource "sdwan_x" "a" {\n  ü = 1\n}\n')
+        self.assertEqual (entry["data_sources"], ["d1"])
+        self.assertEqual (manifest.lookup ("sdwan_x.b", "hash-b", self.id_facts)["text"], 'resource "sdwan_x" "b" {}\n')
+        self.assertEqual ((manifest.hits, manifest.misses), (2, 0))
+
+    def test_reused_entries_kept (self):
+        """ a reused entry is carried over to the next manifest """
+
+        manifest = tf_library.render_manifest (self.filename, self.settings)
+        manifest.lookup ("sdwan_x.a", "hash-a", self.id_facts)
+        manifest.write ()
+        manifest = tf_library.render_manifest (self.filename, self.settings)
+        self.assertIsNotNone (manifest.lookup ("sdwan_x.a", "hash-a", self.id_facts))
+        self.assertIsNone (manifest.lookup ("sdwan_x.b", "hash-b", self.id_facts))
+
+    def test_changed_content (self):
+        manifest = tf_library.render_manifest (self.filename, self.settings)
+        self.assertIsNone (manifest.lookup ("sdwan_x.a", "hash-changed", self.id_facts))
+        self.assertEqual (manifest.misses, 1)
+
+    def test_changed_reference (self):
+        """ the text depends on the name of the referenced object """
+
+        manifest = tf_library.render_manifest (self.filename, self.settings)
+        self.assertIsNone (manifest.lookup ("sdwan_x.a", "hash-a", lambda id: ["sdwan_x.renamed", "x"]))
+
+    def test_changed_settings (self):
+        manifest = tf_library.render_manifest (self.filename, {**self.settings, "format": "json"})
+        self.assertIsNone (manifest.lookup ("sdwan_x.b", "hash-b", self.id_facts))
+
+    def test_missing_texts (self):
+        os.remove (f"{self.filename}.texts")
+        manifest = tf_library.render_manifest (self.filename, self.settings)
+        self.assertIsNone (manifest.lookup ("sdwan_x.b", "hash-b", self.id_facts))
+
+if __name__ == '__main__':
+    unittest.main ()
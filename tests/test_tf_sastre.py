@@ -0,0 +1,196 @@
+import os, io, sys, json, shutil, tempfile, unittest
+from unittest import mock
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+import tf_sastre
+
+# Minimal sastre backup: DT_1 uses FT_1, DT_2 uses FT_2
+backup_ids = {"DT_1": "11111111-0000-0000-0000-000000000001", "DT_2": "11111111-0000-0000-0000-000000000002",
+              "FT_1": "22222222-0000-0000-0000-000000000001", "FT_2": "22222222-0000-0000-0000-000000000002"}
+deleted_id = "33333333-0000-0000-0000-000000000001"
+
+def write_json (filename, content):
+    os.makedirs (os.path.dirname (filename), exist_ok=True)
+    with open(filename, "w") as file:
+        json.dump (content, file)
+
+def write_backup (source_dir):
+    write_json (f"{source_dir}inventory/device_templates.json",
+                [{"templateName": name, "templateId": backup_ids[name], "deviceType": "vedge-C8000V", "configType": "template"}
+                 for name in ["DT_1", "DT_2"]])
+    write_json (f"{source_dir}inventory/feature_templates.json",
+                [{"templateName": name, "templateId": backup_ids[name], "templateType": "cisco_system", "deviceType": ["vedge-C8000V"]}
+                 for name in ["FT_1", "FT_2"]])
+    for (device_template, feature_template) in [("DT_1", "FT_1"), ("DT_2", "FT_2")]:
+        write_json (f"{source_dir}device_templates/template/{device_template}.json",
+                    {"templateId": backup_ids[device_template], "templateName": device_template,
+                     "generalTemplates": [{"templateId": backup_ids[feature_template], "subTemplates": []}]})
+        write_json (f"{source_dir}feature_templates/{feature_template}.json",
+                    {"templateId": backup_ids[feature_template], "templateName": feature_template, "templateDefinition": {}})
+
+# -------------------------------------------------------------------------------------------------
+class test_json_stream_reader (unittest.TestCase):
+    """ Every chunk size, so that each string, escape and number is cut at every position """
+
+    values = ["plain", "esc \" \\ \n \u00e9 \U0001f600", "ünïcödé", 1234567890, -12.5e-3, 0, True, False, None,
+              {"nested": [1, 22, 333, {"key": "va,lue]"}]}, []]
+
+    def read_values (self, text, chunk_size):
+        with mock.patch.object (tf_sastre, "stream_chunk_size", chunk_size):
+            reader = tf_sastre.json_stream_reader (io.StringIO (text))
+            values = []
+            reader.expect ("[")
+            while reader.peek () != "]":
+                values.append (reader.value ())
+                if reader.peek () == ",":
+                    reader.expect (",")
+            reader.expect ("]")
+        return values
+
+    def test_chunk_boundaries (self):
+        for text in [json.dumps (self.values), json.dumps (self.values, indent=2, ensure_ascii=False)]:
+            for chunk_size in range (1, 40):
+                self.assertEqual (self.read_values (text, chunk_size), json.loads (text), f"chunk size {chunk_size}")
+
+    def test_number_at_end (self):
+        """ a number ending a chunk is only complete once the next chunk is read """
+
+        self.assertEqual (self.read_values ("[12345678]", 4), [12345678])
+        self.assertEqual (self.read_values ("[1.5e10, 7]", 3), [1.5e10, 7])
+
+    def test_truncated (self):
+        with self.assertRaises (json.decoder.JSONDecodeError):
+            self.read_values ('["unterminated', 4)
+
+    def test_stream_tf_resources (self):
+        state_dir = tempfile.mkdtemp ()
+        try:
+            tfstate = {"version": 4, "serial": 12, "resources": [{"type": "sdwan_x", "name": f"n{idx}", "instances": [{"attributes": {"id": str (idx)}}]}
+                                                                 for idx in range (20)], "check_results": None}
+            write_json (f"{state_dir}/{tf_sastre.tfstate_file}", tfstate)
+            with mock.patch.object (tf_sastre, "stream_chunk_size", 7):
+                header = {}
+                resources = list (tf_sastre.stream_tf_resources (f"{state_dir}/{tf_sastre.tfstate_file}", header))
+            self.assertEqual (resources, tfstate["resources"])
+            self.assertEqual (header, {"version": 4, "serial": 12, "check_results": None})
+        finally:
+            shutil.rmtree (state_dir)
+
+# -------------------------------------------------------------------------------------------------
+def device_values (count, start=0):
+    return {"header": {"columns": []}, "data": [{"csv-deviceId": f"device-{idx}", "csv-host-name": f"host-{idx}"} for idx in range (start, start + count)]}
+
+def chunk_devices (chunks):
+    return {name: [device["csv-deviceId"] for device in values["data"]] for (name, values) in chunks}
+
+class test_device_chunks (unittest.TestCase):
+    def test_no_split (self):
+        variables = device_values (10)
+        self.assertEqual (tf_sastre.device_chunks ("DT", variables, 0), [("DT", variables)])
+        self.assertEqual (tf_sastre.device_chunks ("DT", variables, 10), [("DT", variables)])
+
+    def test_split (self):
+        chunks = chunk_devices (tf_sastre.device_chunks ("DT", device_values (100), 10))
+        self.assertTrue (all (name.startswith ("DT_chunk") for name in chunks))
+        self.assertTrue (all (len (devices) <= 10 for devices in chunks.values()))
+        devices = [device for chunk in chunks.values() for device in chunk]
+        self.assertEqual (sorted (devices), sorted (f"device-{idx}" for idx in range (100)))
+
+    def test_stable (self):
+        """ adding a device only changes the chunk it goes to """
+
+        before = chunk_devices (tf_sastre.device_chunks ("DT", device_values (100), 10))
+        after = chunk_devices (tf_sastre.device_chunks ("DT", device_values (101), 10))
+        changed = [name for name in after if after[name] != before.get (name)]
+        self.assertLessEqual (len (changed), 2)     # the bucket of the new device, and its overflow chunk if it got full
+        self.assertTrue (any ("device-100" in after[name] for name in changed))
+
+class test_attach_moves (unittest.TestCase):
+    def resources (self, template_name, variables, chunk_size):
+        return [(template_name, name, values) for (name, values) in tf_sastre.device_chunks (template_name, variables, chunk_size)]
+
+    def test_unchanged (self):
+        resources = self.resources ("DT", device_values (50), 10)
+        previous = {name: ("DT", devices) for name, devices in chunk_devices ((name, values) for (_, name, values) in resources).items()}
+        self.assertEqual (tf_sastre.attach_moves (previous, resources), [])
+
+    def test_chunking_enabled (self):
+        """ the single resource of the previous run is taken over by one of the chunks, only once """
+
+        variables = device_values (50)
+        previous = {"DT": ("DT", [device["csv-deviceId"] for device in variables["data"]])}
+        resources = self.resources ("DT", variables, 10)
+        moves = tf_sastre.attach_moves (previous, resources)
+        self.assertEqual (len (moves), 1)
+        self.assertEqual (moves[0][0], "DT")
+        self.assertIn (moves[0][1], [name for (_, name, _) in resources])
+
+    def test_chunking_disabled (self):
+        variables = device_values (50)
+        chunks = tf_sastre.device_chunks ("DT", variables, 10)
+        previous = {name: ("DT", devices) for name, devices in chunk_devices (chunks).items()}
+        largest = max (chunks, key=lambda chunk: len (chunk[1]["data"]))[0]
+        self.assertEqual (tf_sastre.attach_moves (previous, self.resources ("DT", variables, 0)), [(largest, "DT")])
+
+    def test_other_template (self):
+        """ resources never move across device templates """
+
+        previous = {"DT_A": ("DT_A", ["device-0", "device-1"])}
+        self.assertEqual (tf_sastre.attach_moves (previous, self.resources ("DT_B", device_values (2), 0)), [])
+
+# -------------------------------------------------------------------------------------------------
+class test_tfstate_ids (unittest.TestCase):
+    def test_addresses (self):
+        state_dir = tempfile.mkdtemp ()
+        try:
+            write_json (f"{state_dir}/{tf_sastre.tfstate_file}", {"version": 4, "resources": [
+                {"mode": "data", "type": "sdwan_site_list_policy_object", "name": "SITES", "instances": [{"attributes": {"id": "1"}}]},
+                {"mode": "managed", "type": "sdwan_site_list_policy_object", "name": "SITES", "instances": [{"attributes": {"id": "2"}}]},
+                {"mode": "managed", "module": "module.lists", "type": "sdwan_site_list_policy_object", "name": "SITES",
+                 "instances": [{"index_key": 0, "attributes": {"id": "3"}}, {"index_key": "b", "attributes": {"id": "4"}}]}]})
+            self.assertEqual (tf_sastre.load_tfstate_ids (f"{state_dir}/{tf_sastre.tfstate_file}"),
+                              {"2": "sdwan_site_list_policy_object.SITES",
+                               "3": "module.lists.sdwan_site_list_policy_object.SITES[0]",
+                               "4": 'module.lists.sdwan_site_list_policy_object.SITES["b"]'})
+        finally:
+            shutil.rmtree (state_dir)
+
+    def test_no_tfstate (self):
+        self.assertEqual (tf_sastre.load_tfstate_ids ("/nonexistent/terraform.tfstate"), {})
+
+# -------------------------------------------------------------------------------------------------
+class test_incremental_import (unittest.TestCase):
+    def setUp (self):
+        self.cwd = os.getcwd ()
+        self.work_dir = tempfile.mkdtemp ()
+        os.chdir (self.work_dir)
+        write_backup ("data/")
+
+    def tearDown (self):
+        os.chdir (self.cwd)
+        shutil.rmtree (self.work_dir)
+
+    def test_device_template_keeps_unselected (self):
+        """ --incremental --device_template: objects outside the closure are still in the backup, not stale """
+
+        (import_items, inventory_ids) = tf_sastre.load_json_directory ("data//inventory")
+        resources = [{"mode": "managed", "type": address.split (".")[0], "name": address.split (".")[1], "instances": [{"attributes": {"id": id}}]}
+                     for (address, id) in import_items]
+        resources.append ({"mode": "managed", "type": "sdwan_cisco_system_feature_template", "name": "GONE", "instances": [{"attributes": {"id": deleted_id}}]})
+        write_json (f"./{tf_sastre.tfstate_file}", {"version": 4, "resources": resources})
+        self.assertEqual (inventory_ids, set (backup_ids.values ()))
+
+        with mock.patch.object (tf_sastre, "terraform_state_rm") as state_rm, \
+             mock.patch.object (tf_sastre.metrics, "system", return_value=0), \
+             mock.patch.object (tf_sastre.os, "system", return_value=0):
+            tf_sastre.terraform_import ("data/", "./", False, incremental=True, device_templates=["DT_1"])
+
+        state_rm.assert_called_once_with (["sdwan_cisco_system_feature_template.GONE"])
+
+    def test_schema_check_writes_report_only (self):
+        write_json ("./real.tfstate", {"version": 4, "resources": []})
+        tf_sastre.terraform_import ("data/", "./", False, schema_check="real.tfstate")
+        self.assertEqual (sorted (os.listdir (".")), sorted (["data", "real.tfstate", tf_sastre.target_fname_schema]))
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,191 @@
+import os, json, logging, ssl, threading, http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+# Live vManage API data, saved in the same layout as the sastre backup:
+#   <source_dir>/inventory/<sastre type>.json, <source_dir>/device_templates/values/<template name>.json
+
+api_jobs = 8            # concurrent API requests
+page_size = 1000        # for APIs returning pageInfo
+api_timeout = 120       # seconds per request
+
+# sastre type -> API path (relative to /dataservice)
+api_paths = {
+    "config_groups": "/v1/config-group",
+    "device_templates": "/template/device",
+    "feature_profiles_sdwan_cli": "/v1/feature-profile/sdwan/cli",
+    "feature_profiles_sdwan_application_priority": "/v1/feature-profile/sdwan/application-priority",
+    "feature_profiles_sdwan_service": "/v1/feature-profile/sdwan/service",
+    "feature_profiles_sdwan_system": "/v1/feature-profile/sdwan/system",
+    "feature_profiles_sdwan_transport": "/v1/feature-profile/sdwan/transport",
+    "feature_templates": "/template/feature",
+    "policy_templates_security": "/template/policy/security",
+    "policy_templates_vedge": "/template/policy/vedge",
+    "policy_templates_vsmart": "/template/policy/vsmart",
+}
+
+policy_list_types = ["app", "appprobe", "class", "color", "dataprefix", "fqdn", "localapp", "port", "preferredcolorgroup", "prefix",
+                     "protocol", "site", "sla", "tloc", "vpn", "zone"]
+policy_definition_types = ["acl", "approute", "cflowd", "control", "data", "deviceaccess", "qosmap", "rewriterule", "ruleset",
+                           "securitygroup", "vedgeroute", "zonebasedfw"]
+
+# where sastre type suffix and API path differ
+api_path_fix = {
+    "protocol": "protocolname",
+    "deviceaccess": "deviceaccesspolicy",
+}
+
+for list_type in policy_list_types:
+    api_paths[f"policy_lists_{list_type}"] = f"/template/policy/list/{api_path_fix.get (list_type, list_type)}"
+for definition_type in policy_definition_types:
+    api_paths[f"policy_definitions_{definition_type}"] = f"/template/policy/definition/{api_path_fix.get (definition_type, definition_type)}"
+
+# -------------------------------------------------------------------------------------------------
+# Helper class
+class vmanage_client:
+    """ vManage REST client: one persistent connection per thread, shared session cookie and XSRF token """
+
+    def __init__ (self, url, username, password, insecure=False):
+        if "://" not in url:
+            url = f"https://{url}"
+        parsed = urllib.parse.urlparse (url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.context = ssl.create_default_context()
+        if insecure:
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+        self.local = threading.local()
+        self.headers = {}
+
+        self.login (username, password)
+
+    def connection (self):
+        if not getattr (self.local, "connection", None):
+            if self.scheme == "https":
+                self.local.connection = http.client.HTTPSConnection (self.netloc, context=self.context, timeout=api_timeout)
+            else:
+                self.local.connection = http.client.HTTPConnection (self.netloc, timeout=api_timeout)
+        return self.local.connection
+
+    def request (self, method, path, body=None, headers={}):
+        """ returns (status, body, response), reconnects once if the kept-alive connection was closed by the server
+            OSError covers connection reset, timeouts and TLS errors
+        """
+
+        for attempt in range(2):
+            connection = self.connection ()
+            try:
+                connection.request (method, path, body=body, headers={**self.headers, **headers})
+                response = connection.getresponse ()
+                return (response.status, response.read(), response)
+            except (http.client.HTTPException, OSError) as exception:
+                connection.close ()
+                self.local.connection = None
+                if attempt:
+                    raise SystemExit (f"vManage API request {method} {path} failed ({exception}), exiting...")
+
+    def login (self, username, password):
+        body = urllib.parse.urlencode ({"j_username": username, "j_password": password})
+        status, content, response = self.request ("POST", "/j_security_check", body, {"Content-Type": "application/x-www-form-urlencoded"})
+        # vManage answers 200 with the login page again on wrong credentials
+        if status != 200 or b"<html" in content.lower():
+            raise SystemExit (f"vManage login failed (HTTP {status}), exiting...")
+
+        cookies = [cookie.split(";")[0] for cookie in response.headers.get_all ("Set-Cookie") or []]
+        self.headers["Cookie"] = "; ".join (cookies)
+
+        status, token, response = self.request ("GET", "/dataservice/client/token")
+        if status == 200:
+            self.headers["X-XSRF-TOKEN"] = token.decode()
+
+    def get (self, path):
+        status, content, response = self.request ("GET", f"/dataservice{path}")
+        if status != 200:
+            logging.warning (f"vManage API GET {path}: HTTP {status}")
+            return None
+        return json.loads (content)
+
+    def post (self, path, payload):
+        status, content, response = self.request ("POST", f"/dataservice{path}", json.dumps (payload), {"Content-Type": "application/json"})
+        if status != 200:
+            logging.warning (f"vManage API POST {path}: HTTP {status}")
+            return None
+        return json.loads (content)
+
+    def get_data (self, path):
+        """ GET returning list of items, following pageInfo.moreEntries """
+
+        items = []
+        separator = "&" if "?" in path else "?"
+        query = f"{separator}count={page_size}"
+        while True:
+            content = self.get (f"{path}{query}")
+            if content is None:
+                return None
+            if type (content) == list:
+                return content
+
+            items += content.get ("data", [])
+            page_info = content.get ("pageInfo", {})
+            if not page_info.get ("moreEntries"):
+                return items
+            query = f"{separator}startId={page_info.get('endId')}&count={page_size}"
+
+# -------------------------------------------------------------------------------------------------
+def save_json (content, path):
+    os.makedirs (os.path.dirname (path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump (content, file, indent=2)
+    os.replace (f"{path}.tmp", path)
+
+# -------------------------------------------------------------------------------------------------
+def fetch_inventory (client, source_dir, jobs=api_jobs):
+    """ Index of all supported object types -> <source_dir>/inventory/<sastre type>.json """
+
+    def fetch (sastre_type):
+        items = client.get_data (api_paths[sastre_type])
+        if items is not None:
+            save_json (items, f"{source_dir}inventory/{sastre_type}.json")
+        return (sastre_type, len (items or []))
+
+    with ThreadPoolExecutor (max_workers=jobs) as executor:
+        for sastre_type, count in executor.map (fetch, sorted (api_paths.keys())):
+            logging.debug (f"API: {count} {sastre_type} objects")
+
+# -------------------------------------------------------------------------------------------------
+def fetch_device_values (client, source_dir, jobs=api_jobs):
+    """ Per device template variables of the attached devices -> <source_dir>/device_templates/values/<template name>.json """
+
+    def fetch (device_template):
+        template_id = device_template.get ("templateId")
+        attached = client.get_data (f"/template/device/config/attached/{template_id}") or []
+        device_ids = [device.get ("uuid") for device in attached if device.get ("uuid")]
+        if not device_ids:
+            return 0
+
+        values = client.post ("/template/device/config/input",
+                              {"templateId": template_id, "deviceIds": device_ids, "isEdited": False, "isMasterEdited": False})
+        if values:
+            template_name = device_template.get ("templateName", template_id).replace (os.sep, "_")
+            save_json (values, f"{source_dir}device_templates/values/{template_name}.json")
+        return len (device_ids)
+
+    device_templates = client.get_data (api_paths["device_templates"]) or []
+    with ThreadPoolExecutor (max_workers=jobs) as executor:
+        count = sum (executor.map (fetch, device_templates))
+    logging.debug (f"API: variables for {count} devices in {len (device_templates)} device templates")
+
+# -------------------------------------------------------------------------------------------------
+def api_client ():
+    """ Same credentials as the TF provider: TF_VAR_MANAGER_ADDR/USER/PASS (or MANAGER_ADDR/USER/PASS) """
+
+    credentials = {}
+    for name in ["ADDR", "USER", "PASS"]:
+        credentials[name] = os.environ.get (f"TF_VAR_MANAGER_{name}", os.environ.get (f"MANAGER_{name}"))
+        if not credentials[name]:
+            raise SystemExit (f"TF_VAR_MANAGER_{name} is not set, exiting...")
+
+    insecure = os.environ.get ("MANAGER_INSECURE", "") not in ["", "0", "false", "no"]
+
+    return vmanage_client (credentials["ADDR"], credentials["USER"], credentials["PASS"], insecure)
@@ -0,0 +1,117 @@
+import os, sqlite3, hashlib, marshal, logging
+
+# Persistent cache of parsed sastre files, invalidated by file modification time and content hash
+# - inventory files: classified objects (TF type, TF name, ID, skip reason), looked up by file
+# - other files (e.g. device template values): parsed JSON content, stored with marshal
+
+cache_version = 1       # bump when classification rules or stored format change
+
+# -------------------------------------------------------------------------------------------------
+def file_hash (path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as content_file:
+        for chunk in iter (lambda: content_file.read(1 << 20), b""):
+            digest.update (chunk)
+    return digest.hexdigest()
+
+# -------------------------------------------------------------------------------------------------
+# Helper class
+class inventory_cache:
+    def __init__ (self, filename):
+        self.filename = filename
+        try:
+            self.db = sqlite3.connect (filename, timeout=30)
+            self.init_db ()
+        except sqlite3.Error as exception:
+            raise SystemExit (f"Unable to open cache file '{filename}' ({exception}), exiting...")
+        self.hits = 0
+        self.misses = 0
+
+    def init_db (self):
+        self.db.executescript ("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT, sastre_type TEXT, content BLOB);
+            CREATE TABLE IF NOT EXISTS objects (path TEXT, seq INTEGER, sastre_type TEXT, tf_type TEXT, name TEXT, id TEXT, reason TEXT,
+                                                PRIMARY KEY (path, seq));
+            DROP INDEX IF EXISTS objects_id;
+            DROP INDEX IF EXISTS objects_tf_type;
+        """)
+        row = self.db.execute ("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str (cache_version):
+            logging.info (f"Cache '{self.filename}' is outdated, resetting")
+            self.db.executescript ("DELETE FROM files; DELETE FROM objects;")
+            self.db.execute ("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str (cache_version),))
+            self.db.commit ()
+
+    def is_valid (self, path):
+        """ True if cached entry matches the file: same mtime and size, or same content hash """
+
+        path = os.path.abspath (path)
+        row = self.db.execute ("SELECT mtime, size, hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return False
+
+        stat = os.stat (path)
+        if row[0] == stat.st_mtime and row[1] == stat.st_size:
+            return True
+
+        if row[1] == stat.st_size and row[2] == file_hash (path):
+            # touched, but not changed
+            self.db.execute ("UPDATE files SET mtime = ? WHERE path = ?", (stat.st_mtime, path))
+            return True
+
+        return False
+
+    def store_file (self, path, sastre_type, content=None):
+        path = os.path.abspath (path)
+        stat = os.stat (path)
+        blob = marshal.dumps (content) if content is not None else None
+        self.db.execute ("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                         (path, stat.st_mtime, stat.st_size, file_hash (path), sastre_type, blob))
+
+    # ---------------------------------------------------------------------------------------------
+    def lookup_records (self, path):
+        """ returns (sastre_type, [(TF type, TF name, ID, skip reason), ...]) or None if not cached """
+
+        if not self.is_valid (path):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        path = os.path.abspath (path)
+        sastre_type = self.db.execute ("SELECT sastre_type FROM files WHERE path = ?", (path,)).fetchone()[0]
+        records = self.db.execute ("SELECT tf_type, name, id, reason FROM objects WHERE path = ? ORDER BY seq", (path,)).fetchall()
+        return (sastre_type, records)
+
+    def store_records (self, path, sastre_type, records):
+        self.store_file (path, sastre_type)
+        path = os.path.abspath (path)
+        self.db.execute ("DELETE FROM objects WHERE path = ?", (path,))
+        self.db.executemany ("INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(path, seq, sastre_type) + tuple (record) for seq, record in enumerate (records)])
+
+    def lookup_content (self, path):
+        """ returns parsed JSON content or None if not cached """
+
+        if not self.is_valid (path):
+            self.misses += 1
+            return None
+
+        row = self.db.execute ("SELECT content FROM files WHERE path = ?", (os.path.abspath (path),)).fetchone()
+        if row[0] is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return marshal.loads (row[0])
+
+    def store_content (self, path, content):
+        self.store_file (path, None, content)
+
+    def commit (self):
+        self.db.commit ()
+
+    def close (self):
+        self.db.commit ()
+        self.db.close ()
+        logging.info (f"Cache '{self.filename}': {self.hits} hits, {self.misses} misses")
@@ -0,0 +1,297 @@
+import os, sys, re, json, glob, logging, subprocess, threading, time, fcntl, contextlib, platform
+from concurrent.futures import ThreadPoolExecutor
+from tf_metrics import metrics
+
+# working variables ###
+max_jobs = 8            # concurrency cap: every "terraform import" logs in and reads from vManage API
+import_retries = 2      # per object retries within the shard
+retry_delay = 5         # seconds, doubled on every retry
+retry_delay_max = 60    # seconds
+
+# "terraform import" output of failures worth a retry (vManage/API not reachable or overloaded), anything else
+# (bad ID, resource already managed, unsupported type...) fails right away. Same pattern in Python and "grep -Ei".
+transient_errors = (r'timeout|timed out|deadline exceeded|connection reset|connection refused|unexpected EOF|TLS handshake|'
+                    r'too many requests|temporarily unavailable|status ?code[ :=]*5[0-9][0-9]|HTTP[ /.0-9]*5[0-9][0-9]|'
+                    r'5[0-9][0-9] (Internal Server Error|Bad Gateway|Service Unavailable|Gateway Timeout)')
+transient_pattern = re.compile (transient_errors, re.IGNORECASE)
+
+def retry_delays (retries=import_retries):
+    """ Exponential backoff: delay before retry 1, 2, ... """
+
+    return [min (retry_delay * 2 ** attempt, retry_delay_max) for attempt in range(retries)]
+
+# -------------------------------------------------------------------------------------------------
+@contextlib.contextmanager
+def file_lock (filename):
+    """ Exclusive lock across processes (e.g. batch jobs running "terraform init" on a shared plugin cache), no-op without filename """
+
+    if not filename:
+        yield
+        return
+
+    with open(filename, "a") as lock_file:
+        fcntl.flock (lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock (lock_file, fcntl.LOCK_UN)
+
+# -------------------------------------------------------------------------------------------------
+# Helper class
+# Checkpoint journal: one JSON line {"address": TF address, "id": ID} per completed import, appended (and synced) right
+# after "terraform import" succeeds. The journal exists while an import run is unfinished, a new run resumes from it.
+class import_journal:
+    def __init__ (self, filename):
+        self.filename = filename
+        self.lock = threading.Lock ()
+
+    def exists (self):
+        return os.path.exists (self.filename)
+
+    def completed (self):
+        """ ID -> TF address of the completed imports, a line cut short by a crash is ignored """
+
+        completed = {}
+        try:
+            with open(self.filename, "r") as content_file:
+                for line in content_file:
+                    try:
+                        entry = json.loads (line)
+                    except json.decoder.JSONDecodeError:
+                        continue
+                    completed[entry["id"]] = entry["address"]
+        except OSError:
+            pass
+        return completed
+
+    def start (self):
+        open(self.filename, "a").close ()
+
+    def record (self, object_address, object_id):
+        with self.lock:
+            with open(self.filename, "a") as file:
+                file.write (json.dumps ({"address": object_address, "id": object_id}) + "\n")
+                file.flush ()
+                os.fsync (file.fileno ())
+
+    def remove (self):
+        try:
+            os.remove (self.filename)
+        except OSError:
+            pass
+
+# -------------------------------------------------------------------------------------------------
+def shard_items (import_items, jobs):
+    """ Round-robin split of (TF address, ID) list into "jobs" shards """
+
+    shards = [[] for _ in range(jobs)]
+    for idx, item in enumerate(import_items):
+        shards[idx % jobs].append (item)
+
+    return [shard for shard in shards if shard]
+
+# -------------------------------------------------------------------------------------------------
+def run_import_command (object_address, object_id, state_file):
+    """ Returns (imported, transient failure) """
+
+    command = ["terraform", "import", "-input=false", f"-state={state_file}", object_address, object_id]
+    start = time.perf_counter () if metrics.enabled else 0
+    result = subprocess.run (command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if metrics.enabled:
+        metrics.command (" ".join (command), time.perf_counter () - start, result.returncode)
+    if result.returncode != 0:
+        logging.debug (result.stdout)
+
+    return (result.returncode == 0, result.returncode != 0 and bool (transient_pattern.search (result.stdout or "")))
+
+# -------------------------------------------------------------------------------------------------
+def run_shard (shard_no, shard, state_file, retries, journal=None):
+    """ Import shard objects one by one into the shard's own state file, return failed items
+        Only transient failures are retried
+    """
+
+    delays = retry_delays (retries)
+    failed = []
+    for (object_address, object_id) in shard:
+        for attempt in range(retries + 1):
+            (imported, transient) = run_import_command (object_address, object_id, state_file)
+            if imported:
+                logging.debug (f"Shard {shard_no}: imported {object_address}")
+                if journal:
+                    journal.record (object_address, object_id)
+                break
+            if not transient:
+                logging.warning (f"Shard {shard_no}: import of {object_address} failed, not retried")
+                failed.append ((object_address, object_id))
+                break
+            logging.warning (f"Shard {shard_no}: import of {object_address} failed (attempt {attempt + 1} of {retries + 1})")
+            if attempt < retries:
+                time.sleep (delays[attempt])
+        else:
+            failed.append ((object_address, object_id))
+
+    return failed
+
+# -------------------------------------------------------------------------------------------------
+def resource_address (resource):
+    return (resource.get("module"), resource.get("mode"), resource.get("type"), resource.get("name"))
+
+def merge_states (state_files, target_file):
+    """ Merge shard tfstate files into target_file (keeping its existing resources), shard files are removed """
+
+    if not state_files:
+        return False
+
+    merged = None
+    existing = [target_file] if os.path.exists(target_file) else []
+    for state_file in existing + state_files:
+        try:
+            with open(state_file, "r") as content_file:
+                state = json.load(content_file)
+        except (OSError, json.decoder.JSONDecodeError) as exception:
+            logging.warning (f"Unable to load shard state {state_file} ({exception})")
+            continue
+
+        if merged is None:
+            merged = state
+            addresses = set (resource_address (resource) for resource in merged.get("resources", []))
+        else:
+            # a shard recovered after a crash may repeat resources already merged
+            for resource in state.get("resources", []):
+                if resource_address (resource) not in addresses:
+                    addresses.add (resource_address (resource))
+                    merged["resources"].append (resource)
+            merged["serial"] = max (merged.get("serial", 0), state.get("serial", 0))
+
+    if merged is None:
+        return False
+
+    merged["serial"] = merged.get("serial", 0) + 1
+
+    temp_file = f"{target_file}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump (merged, file, indent=2)
+    os.replace (temp_file, target_file)
+
+    for state_file in state_files:
+        for fname in [state_file, f"{state_file}.backup"]:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    return True
+
+# -------------------------------------------------------------------------------------------------
+def recover_shards (target_file):
+    """ Merge shard state files left behind by an interrupted run into target_file """
+
+    state_files = sorted (fname for fname in glob.glob (f"{target_file}.shard*") if not fname.endswith (".backup"))
+    if state_files:
+        logging.info (f"Recovering {len(state_files)} shard state files of an interrupted import")
+    return merge_states (state_files, target_file)
+
+# -------------------------------------------------------------------------------------------------
+def run_import_shards (import_items, jobs, target_file, retries=import_retries, journal=None):
+    """ Run "terraform import" for all objects in parallel shards and merge the results into target_file
+        Returns list of (TF address, ID) that failed to import
+        journal: import_journal, every completed import is recorded
+    """
+
+    if jobs > max_jobs:
+        logging.warning (f"Limiting import concurrency to {max_jobs} jobs (requested {jobs})")
+        jobs = max_jobs
+
+    shards = shard_items (import_items, jobs)
+    state_files = [f"{target_file}.shard{shard_no}" for shard_no in range(len(shards))]
+    logging.info (f"Importing {len(import_items)} objects using {len(shards)} shards")
+
+    with ThreadPoolExecutor (max_workers=len(shards) or 1) as executor:
+        results = executor.map (run_shard, range(len(shards)), shards, state_files, [retries] * len(shards), [journal] * len(shards))
+        failed = [item for shard_failed in results for item in shard_failed]
+
+    merge_states ([state_file for state_file in state_files if os.path.exists(state_file)], target_file)
+
+    return failed
+
+# -------------------------------------------------------------------------------------------------
+# "terraform init" is only needed when .terraform.lock.hcl and the installed provider don't satisfy the required version
+provider_lock_file = ".terraform.lock.hcl"
+provider_arch = {"x86_64": "amd64", "amd64": "amd64", "aarch64": "arm64", "arm64": "arm64", "i386": "386", "i686": "386", "armv7l": "arm"}
+
+def version_parts (version, size=3):
+    parts = [int (part) for part in re.findall (r'\d+', version.split ("-")[0])]
+    return tuple (parts + [0] * (size - len (parts)))
+
+def version_satisfies (version, constraints):
+    """ TF version constraints, e.g. ">= 0.3.13", ">= 0.3, < 1.0", "~> 0.3.1" """
+
+    current = version_parts (version)
+    for constraint in constraints.split (","):
+        match = re.fullmatch (r'\s*(!=|>=|<=|~>|=|>|<)?\s*v?(\d+(?:\.\d+)*)\s*', constraint)
+        if not match:
+            return False
+        (operator, required) = (match.group (1) or "=", match.group (2))
+        target = version_parts (required)
+        if operator == "~>":
+            # only the rightmost given part may increase
+            prefix = len (required.split (".")) - 1
+            satisfied = current >= target and current[:prefix] == target[:prefix]
+        else:
+            satisfied = {"=": current == target, "!=": current != target, ">": current > target, ">=": current >= target,
+                         "<": current < target, "<=": current <= target}[operator]
+        if not satisfied:
+            return False
+
+    return True
+
+def provider_address (source):
+    """ "CiscoDevNet/sdwan" -> "registry.terraform.io/ciscodevnet/sdwan" """
+
+    source = source.lower ()
+    return source if source.count ("/") == 2 else f"registry.terraform.io/{source}"
+
+def locked_provider_version (source, work_dir="."):
+    try:
+        with open(os.path.join (work_dir, provider_lock_file), "r") as content_file:
+            lock = content_file.read ()
+    except OSError:
+        return None
+
+    match = re.search (r'provider\s+"' + re.escape (provider_address (source)) + r'"\s*\{[^}]*?\bversion\s*=\s*"([^"]+)"', lock)
+    return match.group (1) if match else None
+
+def provider_installed (source, version, work_dir="."):
+    platform_dir = f"{sys.platform.replace ('win32', 'windows')}_{provider_arch.get (platform.machine ().lower (), platform.machine ().lower ())}"
+    install_dir = os.path.join (work_dir, ".terraform", "providers", provider_address (source), version, platform_dir)
+    try:
+        return any (fname.startswith ("terraform-provider-") for fname in os.listdir (install_dir))
+    except OSError:
+        return False
+
+def terraform_init_reason (source, constraints, work_dir="."):
+    """ Why "terraform init" is needed, None if the locked and installed provider version satisfies constraints """
+
+    version = locked_provider_version (source, work_dir)
+    if version is None:
+        return f"no {source} provider in {provider_lock_file}"
+    if not version_satisfies (version, constraints):
+        return f"locked {source} provider {version} does not satisfy '{constraints}'"
+    if not provider_installed (source, version, work_dir):
+        return f"{source} provider {version} is not installed"
+    return None
+
+def use_plugin_cache (directory, break_lock=False):
+    """ TF links providers from the cache instead of downloading them again. Without a lock file TF >= 1.4 only uses
+        the cache with TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE (break_lock), the lock file then records only
+        the hashes of this platform. The cache is not safe for concurrent "terraform init".
+    """
+
+    directory = os.path.abspath (directory)
+    os.makedirs (directory, exist_ok=True)
+    os.environ["TF_PLUGIN_CACHE_DIR"] = directory
+    if break_lock:
+        os.environ["TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE"] = "1"
+        logging.warning ("TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE set: providers are linked from the plugin cache "
+                         "without verifying them against the registry checksums")
+    return directory
@@ -16,52 +16,53 @@ tfstate_file = "terraform.tfstate"
 target_fname_main = f"{target_fname}-config.tf"
 target_fname_import = f"{target_fname}.sh"
 
+# lookup indexes, see build_index()
+index_fields = ['templateName', 'templateId', 'policyId', 'definitionId']
+section_index = {}
+config_index = {}
+
 # TF provider bug
 feature_template_type_fix = {
     "vpn_cedge_interface_cellular": "vpn_interface_cellular"
 }
 
+# ----------------------------------------------------------------------------------------
+def build_index ():
+    """ One pass over the whole config: (section, field, value) -> object and (field, value) -> [section, object]
+        for the name and all ID fields, first match wins same as a linear search would
+    """
+
+    for tld in alldata.keys():
+        for sld in alldata[tld]:
+            data = sld.get('data', {})
+            for field, value in data.items():
+                if (field in index_fields or field.endswith('Id')) and type (value) == str:
+                    section_index.setdefault ((tld, field, value), data)
+                    config_index.setdefault ((field, value), [tld, data])
+
 # ----------------------------------------------------------------------------------------
 def find_device_template (device_template_name):
     """ in: template name; out: template structure """
 
-    for device_template in alldata['feature_device_template']:
-        if device_template['data']['templateName'] == device_template_name:
-            return device_template['data']
-        
-    return None
+    return section_index.get (('feature_device_template', 'templateName', device_template_name))
 
 # ----------------------------------------------------------------------------------------
 def find_feature_template (feature_template_id):
     """ in: template id; out: template structure """
 
-    for feature_template in alldata['feature_templates']:
-        # print (f">>> {feature_template['data']['templateId']} vs. {feature_template_id}")
-        if feature_template['data']['templateId'] == feature_template_id:
-            return feature_template['data']
-        
-    return None
+    return section_index.get (('feature_templates', 'templateId', feature_template_id))
 
 # ----------------------------------------------------------------------------------------
 def find_data_policy (policy_id):
     """ in: policy id; out: template structure """
 
-    for data_policy in alldata['localized_policy']:
-        if data_policy['data']['policyId'] == policy_id:
-            return data_policy['data']
-        
-    return None
+    return section_index.get (('localized_policy', 'policyId', policy_id))
 
 # ----------------------------------------------------------------------------------------
 def find_config_item (id_name, id):
     """ General search across whole config """
 
-    for tld in alldata.keys():
-        for sld in alldata[tld]:
-            if sld.get('data',"").get(id_name) == id:
-                return [tld, sld['data']]
-    
-    return [None, None]
+    return config_index.get ((id_name, id), [None, None])
 
 # ----------------------------------------------------------------------------------------
 def process_feature_template (feature_template):
@@ -141,6 +142,8 @@ def process_device_template (device_template):
 with open(source_filename) as json_data:
     alldata = json.load (json_data)
 
+build_index ()
+
 # init text structures
 text_tf   = mytext(target_fname_main, True) # first TF skeleton
 text_bash = mytext(target_fname_import)     # bash import script
@@ -1,14 +1,18 @@
-import os
+import os, json, logging, filecmp
 
 # target_fname = "sdwan-tf-import"
 
+# required provider, "terraform init" is skipped while the installed one satisfies the version constraint
+tf_provider_source = "CiscoDevNet/sdwan"
+tf_provider_version = ">= 0.3.13"
+
 tf_header = \
 """
 terraform {
   required_providers {
     sdwan = {
-      source = "CiscoDevNet/sdwan"
-      version = ">= 0.3.13"
+      source = "%s"
+      version = "%s"
     }
   }
 }
@@ -23,62 +27,210 @@ provider "sdwan" {
   password = var.MANAGER_PASS
 }
 
-"""
+""" % (tf_provider_source, tf_provider_version)
+
+# same header in Terraform JSON syntax
+tf_header_json = {
+    "terraform": {"required_providers": {"sdwan": {"source": tf_provider_source, "version": tf_provider_version}}},
+    "variable": {"MANAGER_ADDR": {"type": "string"}, "MANAGER_PASS": {"type": "string"}, "MANAGER_USER": {"type": "string"}},
+    "provider": {"sdwan": {"url": "${var.MANAGER_ADDR}", "username": "${var.MANAGER_USER}", "password": "${var.MANAGER_PASS}"}},
+}
 
 # -------------------------------------------------------------------------------------
 # Helper class
+# layout "flat": <basename>-<stream>.tf files, header in the "main" stream
+# layout "streams": every stream is a separate root module <dir>/<stream>/<base>-<stream>.tf with its own header
+# keep_unchanged: see mytext
+# output_format "json": <...>.tf.json files, see json_text
 class text_handler:
-    def __init__ (self, basename):
+    def __init__ (self, basename, layout="flat", keep_unchanged=False, output_format="hcl"):
         self.texts = {}
         self.basename = basename
+        self.layout = layout
+        self.keep_unchanged = keep_unchanged
+        self.output_format = output_format
+
+    def filename (self, stream, fname=None, output_format=None):
+        extension = ".tf.json" if (output_format or self.output_format) == "json" else ".tf"
+        if self.layout == "flat":
+            return f"{self.basename}-{stream}{extension}"
+
+        (dirname, base) = os.path.split (self.basename)
+        module_dir = os.path.join (dirname, stream)
+        os.makedirs (module_dir, exist_ok=True)
+        return os.path.join (module_dir, fname or f"{base}-{stream}{extension}")
 
-    def add (self, stream, line):
+    def add (self, stream, line, kind="resource"):
+        """ HCL: line of text; JSON: serialized block of the given kind ("resource", "data", "variable"), "" only creates the stream """
 
         # if stream does not exist, create it
         if stream not in self.texts.keys():
-            with_header = stream == "main"
-            fname = f"{self.basename}-{stream}.tf"
-            self.texts[stream] = mytext (fname, with_header)
+            with_header = stream == "main" or self.layout == "streams"
+            fname = self.filename (stream)
+            text_class = json_text if self.output_format == "json" else mytext
+            self.texts[stream] = text_class (fname, with_header, self.keep_unchanged)
 
-        self.texts[stream].add (line)
+            # same resources in the other format would be duplicates for TF
+            try:
+                os.remove (self.filename (stream, output_format="hcl" if self.output_format == "json" else "json"))
+            except OSError:
+                pass
+
+        if self.output_format == "json":
+            self.texts[stream].add (line, kind)
+        else:
+            self.texts[stream].add (line)
 
     def write (self):
         for stream in self.texts.keys():
             self.texts[stream].write()
 
+    def remove_stale (self, record_file):
+        """ Remove the files the previous run recorded in record_file which were not written in this run (all the objects
+            of their stream deleted, pruned or deselected), then record the files of this run. Nothing else is removed.
+            The directory of a "streams" module is removed if nothing is left in it, its tfstate is never removed.
+        """
+
+        # relative to the record, the destination may be given differently next time
+        record_dir = os.path.dirname (os.path.abspath (record_file))
+        written = set (os.path.relpath (text.filename, record_dir) for text in self.texts.values())
+        try:
+            with open(record_file, "r") as content_file:
+                previous = json.load (content_file)
+        except (OSError, ValueError):
+            previous = []
+
+        removed = []
+        for relative_name in previous:
+            fname = os.path.join (record_dir, relative_name)
+            if relative_name in written or not os.path.isfile (fname):
+                continue
+            os.remove (fname)
+            removed.append (fname)
+            logging.info (f"Removed {fname}: no objects in this stream any more")
+            if self.layout == "streams":
+                module_dir = os.path.dirname (fname)
+                if os.path.exists (os.path.join (module_dir, "terraform.tfstate")):
+                    logging.warning (f"Stream of {fname} has no objects any more, its tfstate in {module_dir} is left in place")
+                elif os.listdir (module_dir):
+                    logging.warning (f"Stream of {fname} has no objects any more, {module_dir} is not empty, left in place")
+                else:
+                    os.rmdir (module_dir)
+
+        try:
+            with open(f"{record_file}.tmp", "w") as file:
+                json.dump (sorted (written), file, indent=2)
+            os.replace (f"{record_file}.tmp", record_file)
+        except OSError:
+            raise SystemExit (f"Unable to write to the '{record_file}' file, exiting...")
+        return removed
+
 # -------------------------------------------------------------------------------------
 # Helper class
+# Text is kept as a list of chunks and spilled to a temp file every flush_size characters,
+# the temp file is renamed to the target file on write() so TF never sees a partial file
+# keep_unchanged: the previous file is not removed upfront and is left untouched (mtime too) if the new text is identical
+flush_size = 1 << 20
+
 class mytext:
-    def __init__ (self, filename="", with_header=False):
+    def __init__ (self, filename="", with_header=False, keep_unchanged=False):
         self.filename = filename
-        self.text = tf_header if with_header else ""
+        self.chunks = [tf_header] if with_header else []
+        self.size = 0
+        self.temp_file = None
+        self.keep_unchanged = keep_unchanged
 
         # cleanup previous files so they don't mess up with TF
-        if filename:
+        if filename and not keep_unchanged:
             try:
                 os.remove(filename)
             except OSError:
                 pass        
 
+    @property
+    def text (self):
+        if self.temp_file:
+            self.flush ()
+            with open(self.temp_file.name, "r") as file:
+                return file.read()
+        return "".join (self.chunks)
+
     def addraw (self, line):
-        self.text = self.text + line
+        self.chunks.append (line)
+        self.size += len (line)
+        if self.filename and self.size >= flush_size:
+            self.flush ()
 
     def add (self, line):
         self.addraw (line + "\n")
 
+    def flush (self):
+        try:
+            if not self.temp_file:
+                self.temp_file = open(f"{self.filename}.tmp", "w")
+            self.temp_file.write ("".join (self.chunks))
+            self.temp_file.flush ()
+        except OSError:
+            raise SystemExit (f"Unable to write to the '{self.filename}' file, exiting...")
+        self.chunks = []
+        self.size = 0
+
     def write (self):
         if self.filename == "":
             self.print ()
         else:
+            self.flush ()
             try:
-                with open(self.filename, "w") as file:
-                    file.write (self.text)
-            except:
+                self.temp_file.close ()
+                if self.keep_unchanged and os.path.isfile (self.filename) and filecmp.cmp (self.temp_file.name, self.filename, shallow=False):
+                    os.remove (self.temp_file.name)
+                else:
+                    os.replace (self.temp_file.name, self.filename)
+            except OSError:
                 raise SystemExit (f"Unable to write to the '{self.filename}' file, exiting...")
+            self.temp_file = None
     
     def print (self):
         print (self.text)
     
+# -------------------------------------------------------------------------------------
+# Helper class
+# Terraform JSON syntax file {<header>, "variable": [...], "resource": [...], "data": [...]}, written through mytext.
+# Blocks are added already serialized, one per line, blocks of the same kind must be added together.
+class json_text:
+    def __init__ (self, filename="", with_header=False, keep_unchanged=False):
+        self.filename = filename
+        self.text = mytext (filename, False, keep_unchanged)
+        self.members = 0
+        self.kind = None
+
+        self.text.addraw ("{\n")
+        if with_header:
+            for key, value in tf_header_json.items():
+                self.member (key)
+                self.text.addraw (json.dumps (value))
+
+    def member (self, key):
+        self.text.addraw ((",\n" if self.members else "") + f"{json.dumps (key)}: ")
+        self.members += 1
+
+    def add (self, block, kind="resource"):
+        if not block:
+            return
+        if kind != self.kind:
+            if self.kind:
+                self.text.addraw ("\n]")
+            self.member (kind)
+            self.text.addraw ("[\n")
+            self.kind = kind
+        else:
+            self.text.addraw (",\n")
+        self.text.addraw (block)
+
+    def write (self):
+        self.text.addraw ("\n]\n}\n" if self.kind else "\n}\n")
+        self.text.write ()
+
 # -------------------------------------------------------------------------------------
 class all_id_class:
     def __init__ (self):
@@ -104,3 +256,83 @@ class all_id_class:
     def is_seen (self, id):
         item = self.dict.get (id,{})
         return item.get('seen', False)
+
+# -------------------------------------------------------------------------------------
+# Helper class
+# Manifest of the previous "create" run: per resource (TF address) hash of its tfstate content, the facts about
+# referenced IDs the text depends on, the data sources it needed ("streams" layout) and where its rendered text is
+# in <filename>.texts. Only the manifest is loaded, texts are read from the file when reused.
+# An entry is reused only if the run settings, the hash and all the ID facts are unchanged.
+manifest_version = 2
+
+class render_manifest:
+    def __init__ (self, filename, settings):
+        self.filename = filename
+        self.texts_filename = f"{filename}.texts"
+        self.settings = settings
+        self.previous = {}
+        self.previous_texts = None
+        self.resources = {}
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            with open(filename, "r") as content_file:
+                manifest = json.load (content_file)
+            if manifest.get ("version") == manifest_version and manifest.get ("settings") == settings:
+                self.previous_texts = open(self.texts_filename, "rb")
+                self.previous = manifest.get ("resources", {})
+        except (OSError, ValueError):
+            pass
+
+        try:
+            self.texts = open(f"{self.texts_filename}.tmp", "wb")
+        except OSError:
+            raise SystemExit (f"Unable to write to the '{self.texts_filename}' file, exiting...")
+
+    def lookup (self, key, hash, id_facts):
+        """ returns the previous entry with its "text" if still valid, id_facts: ID -> current facts (same as stored at render time) """
+
+        entry = self.previous.get (key)
+        if entry and entry["hash"] == hash and all (id_facts (id) == facts for id, facts in entry["refs"].items()):
+            self.previous_texts.seek (entry["offset"])
+            text = self.previous_texts.read (entry["length"]).decode()
+            self.hits += 1
+            self.store (key, hash, text, entry["refs"], entry["data_sources"])
+            return {**entry, "text": text}
+
+        self.misses += 1
+        return None
+
+    def store (self, key, hash, text, refs, data_sources):
+        content = text.encode()
+        self.resources[key] = {"hash": hash, "offset": self.texts.tell (), "length": len (content), "refs": refs, "data_sources": data_sources}
+        self.texts.write (content)
+
+    def write (self):
+        temp_file = f"{self.filename}.tmp"
+        try:
+            self.texts.close ()
+            if self.previous_texts:
+                self.previous_texts.close ()
+            os.replace (self.texts.name, self.texts_filename)
+            with open(temp_file, "w") as file:
+                json.dump ({"version": manifest_version, "settings": self.settings, "resources": self.resources}, file)
+            os.replace (temp_file, self.filename)
+        except OSError:
+            raise SystemExit (f"Unable to write to the '{self.filename}' file, exiting...")
+
+# -------------------------------------------------------------------------------------
+def dependency_closure (graph, roots):
+    """ IDs reachable from roots (roots included), graph: ID -> set of referenced IDs """
+
+    seen = set()
+    stack = list (roots)
+    while stack:
+        id = stack.pop()
+        if id in seen:
+            continue
+        seen.add (id)
+        stack.extend (graph.get (id, ()))
+
+    return seen
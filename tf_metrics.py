@@ -0,0 +1,189 @@
+import os, json, time, logging, resource, cProfile, pstats, tracemalloc
+
+# Run metrics: per phase wall/CPU time and peak memory, object counts, timing of every external terraform command
+#   Counters, timers and the command list are only collected when enabled, per object calls cost nothing otherwise
+#   batch: the reports of the jobs (run in their own processes) are combined in "jobs", see jobs_summary()
+#   phase() ends the running phase and starts the next one, so long procedural functions need no re-indenting
+#   Peak RSS is the process high-water mark at the end of the phase (it never goes down),
+#   traced_peak_kb is the Python allocation peak within the phase, only available with --profile (tracemalloc)
+
+# -------------------------------------------------------------------------------------------------
+# Helper class
+class metrics_collector:
+    def __init__ (self):
+        self.enabled = False
+        self.action = None
+        self.reset ()
+
+    def reset (self):
+        """ Start over, e.g. for the next action of a batch job (enabled and action are kept) """
+
+        self.phases = []
+        self.current = None
+        self.counts = {}
+        self.timers = {}
+        self.commands = []
+        self.jobs = []
+        self.start = (time.perf_counter (), time.process_time ())
+
+    def snapshot (self):
+        children = os.times ()
+        return {"wall": time.perf_counter (), "cpu": time.process_time (),
+                "children_cpu": children.children_user + children.children_system}
+
+    def phase (self, name):
+        """ End the running phase (if any) and start a new one, phase(None) only ends it """
+
+        self.end_phase ()
+        if name is None:
+            return
+        if tracemalloc.is_tracing () and hasattr (tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak ()
+        self.current = (name, self.snapshot ())
+        logging.debug (f"Phase {name}")
+
+    def end_phase (self):
+        if self.current is None:
+            return
+
+        (name, start) = self.current
+        end = self.snapshot ()
+        phase = {"name": name,
+                 "wall_s": round (end["wall"] - start["wall"], 4),
+                 "cpu_s": round (end["cpu"] - start["cpu"], 4),
+                 "children_cpu_s": round (end["children_cpu"] - start["children_cpu"], 4),
+                 "peak_rss_kb": resource.getrusage (resource.RUSAGE_SELF).ru_maxrss}
+        if tracemalloc.is_tracing ():
+            phase["traced_peak_kb"] = tracemalloc.get_traced_memory ()[1] // 1024
+        self.phases.append (phase)
+        self.current = None
+
+    def count (self, section, key, value=1):
+        if not self.enabled:
+            return
+        counts = self.counts.setdefault (section, {})
+        counts[key] = counts.get (key, 0) + value
+
+    def add_time (self, name, seconds):
+        """ Accumulated time of a step repeated within a phase (e.g. attribute sorting) """
+
+        if self.enabled:
+            self.timers[name] = self.timers.get (name, 0) + seconds
+
+    def command (self, command, wall, returncode):
+        if not self.enabled:
+            return
+        self.commands.append ({"command": command, "wall_s": round (wall, 4), "returncode": returncode})
+
+    def system (self, command):
+        """ os.system() with the command timed """
+
+        if not self.enabled:
+            return os.system (command)
+
+        start = time.perf_counter ()
+        result = os.system (command)
+        self.command (command, time.perf_counter () - start, result)
+        return result
+
+    def load_command_timings (self, filename):
+        """ Timings written by the import script: "<start> <end> <return code> <TF address>" per line """
+
+        try:
+            with open(filename, "r") as content_file:
+                for line in content_file:
+                    [start, end, returncode, address] = line.split (maxsplit=3)
+                    self.command (f"terraform import {address.strip()}", float (end) - float (start), int (returncode))
+        except (OSError, ValueError) as exception:
+            logging.warning (f"Unable to load command timings from {filename} ({exception})")
+
+    def job (self, result):
+        """ Outcome of a batch job: {"name", "error", "actions": {action: report()}} """
+
+        self.jobs.append (result)
+
+    def jobs_summary (self):
+        """ Batch jobs combined: totals, per action phase totals (summed over the jobs) and the job reports """
+
+        phases = {}
+        commands = {"count": 0, "failed": 0, "wall_s": 0}
+        job_wall = []
+        for job in self.jobs:
+            job_wall.append (sum (report["wall_s"] for report in job["actions"].values()))
+            for action, report in job["actions"].items():
+                for phase in report["phases"]:
+                    total = phases.setdefault (f"{action}.{phase['name']}", {"wall_s": 0, "cpu_s": 0, "children_cpu_s": 0, "max_peak_rss_kb": 0})
+                    for key in ["wall_s", "cpu_s", "children_cpu_s"]:
+                        total[key] = round (total[key] + phase[key], 4)
+                    total["max_peak_rss_kb"] = max (total["max_peak_rss_kb"], phase["peak_rss_kb"])
+                for key in commands.keys():
+                    commands[key] = round (commands[key] + report["commands"][key], 4)
+
+        return {"count": len (self.jobs),
+                "failed": sum (1 for job in self.jobs if job["error"]),
+                "wall_s": round (sum (job_wall), 4),
+                "max_wall_s": max (job_wall, default=0),
+                "phases": phases,
+                "commands": commands,
+                "calls": self.jobs}
+
+    # ---------------------------------------------------------------------------------------------
+    def report (self):
+        self.end_phase ()
+
+        durations = [command["wall_s"] for command in self.commands]
+        report = {"action": self.action,
+                "wall_s": round (time.perf_counter () - self.start[0], 4),
+                "cpu_s": round (time.process_time () - self.start[1], 4),
+                "peak_rss_kb": resource.getrusage (resource.RUSAGE_SELF).ru_maxrss,
+                "children_peak_rss_kb": resource.getrusage (resource.RUSAGE_CHILDREN).ru_maxrss,
+                "phases": self.phases,
+                "timers": {name: round (seconds, 4) for name, seconds in self.timers.items()},
+                "counts": self.counts,
+                "commands": {"count": len (durations),
+                             "failed": sum (1 for command in self.commands if command["returncode"] != 0),
+                             "wall_s": round (sum (durations), 4),
+                             "max_s": max (durations, default=0),
+                             "calls": self.commands}}
+        if self.jobs:
+            report["jobs"] = self.jobs_summary ()
+        return report
+
+    def write (self, filename):
+        temp_file = f"{filename}.tmp"
+        try:
+            with open(temp_file, "w") as file:
+                json.dump (self.report (), file, indent=2)
+            os.replace (temp_file, filename)
+        except OSError as exception:
+            logging.error (f"Unable to write metrics to '{filename}' ({exception})")
+            return
+        logging.info (f"Metrics written to {filename}")
+
+metrics = metrics_collector ()
+
+# -------------------------------------------------------------------------------------------------
+# Helper class
+# cProfile + tracemalloc for the whole run: <prefix>.prof (pstats/snakeviz), <prefix>.txt (top functions and allocations)
+class run_profiler:
+    def __init__ (self, prefix):
+        self.prefix = prefix
+        self.profile = cProfile.Profile ()
+
+    def start (self):
+        tracemalloc.start ()
+        self.profile.enable ()
+
+    def stop (self, top=30):
+        self.profile.disable ()
+        snapshot = tracemalloc.take_snapshot ()
+        tracemalloc.stop ()
+
+        self.profile.dump_stats (f"{self.prefix}.prof")
+        with open(f"{self.prefix}.txt", "w") as file:
+            stats = pstats.Stats (self.profile, stream=file)
+            stats.sort_stats ("cumulative").print_stats (top)
+            file.write (f"Top {top} allocations by line (tracemalloc):\n")
+            for stat in snapshot.statistics ("lineno")[:top]:
+                file.write (f"{stat}\n")
+        logging.info (f"Profile written to {self.prefix}.prof and {self.prefix}.txt")
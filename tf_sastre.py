@@ -1,26 +1,89 @@
-from tf_library import mytext,text_handler,all_id_class
-import os, sys, json, re
-import logging, argparse
+from tf_library import mytext,text_handler,all_id_class,dependency_closure,render_manifest,tf_provider_source,tf_provider_version
+from tf_executor import run_import_shards, merge_states, recover_shards, import_journal, import_retries, retry_delays, file_lock
+from tf_executor import terraform_init_reason, use_plugin_cache, transient_errors
+from tf_cache import inventory_cache
+from tf_api import api_client, fetch_inventory, fetch_device_values
+from tf_metrics import metrics, run_profiler
+from tf_synth import synthesize_resources, write_tfstate, check_schema_coverage, verified_types
+import os, sys, json, re, fnmatch
+import logging, argparse, functools, hashlib, uuid, time, multiprocessing
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# faster JSON parser, if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # working variables ###
 target_fname = "sdwan-tf-import"
 target_fname_tf = f"{target_fname}-config.tf"
 target_fname_bash = f"{target_fname}.sh"
+target_fname_imports = "imports.tf"
+target_fname_plan = f"{target_fname}.tfplan"
+target_fname_timings = f"{target_fname}.timings"     # --metrics: per "terraform import" timing written by the script
+target_fname_schema = f"{target_fname}-schema.json"  # --schema_check report
+target_fname_journal = f"{target_fname}.journal"     # completed imports of an unfinished run, see import_journal
+target_fname_manifest = f"{target_fname}.manifest.json"    # create --incremental, see render_manifest
+target_fname_pruned = f"{target_fname}-pruned.json"  # create --prune report
+target_fname_outputs = f"{target_fname}-outputs.json"    # create: files written by the last run, see text_handler.remove_stale
+target_fname_tfvars = f"{target_fname}-variables.auto.tfvars.json"
+target_fname_chunks = f"{target_fname}-chunks.json"  # vars --chunk_size: devices of every attach resource, for moved {} blocks
+tfvars_variable = "device_variables"
 
 local_dir = "."
 tfstate_file = "terraform.tfstate"
 
 skip_defaults = True    # Skip default device templates
+stream_chunk_size = 1 << 16     # tfstate read size in streaming mode
+render_batch_size = 64          # create: resources per process pool task
+render_window = 4096            # create: resources read ahead and rendered in parallel before the output is merged
+render_parallel_min = 2000      # create: smaller tfstates are rendered in a single process
 
 tf_type_device_template = "sdwan_feature_device_template"
 tf_type_device_cli = "sdwan_cli_device_template"
 tf_type_device_attach = "sdwan_attach_feature_device_template"
 
+# create --prune: objects not reachable from these are unreferenced
+prune_root_types = [tf_type_device_template, tf_type_device_cli, "sdwan_centralized_policy", "sdwan_security_policy",
+                    "sdwan_configuration_group"]
+prune_stream = "unreferenced"
+removed_stream = "removed"      # create --prune drop, "flat" layout: removed {} blocks of the dropped objects (TF >= 1.7)
+
+pattern_for_object_id = re.compile (r'\w{8}-\w{4}-\w{4}-\w{4}-\w{12}')
+
+current_partition = None    # "streams" layout: stream of the resource being rendered
+data_sources = {}           # "streams" layout: stream -> {TF name: ID} of objects referenced from other streams
+render_record = None        # create --incremental: ID facts and data sources used by the resource being rendered
+render_streams = False      # create process pool workers: "streams" layout
+pruned_ids = set()          # create --prune split: IDs of unreferenced objects, rendered in prune_stream
+output_format = "hcl"       # create/vars --format: "hcl" or "json" (Terraform JSON syntax, .tf.json)
+init_lock = None            # batch: lock file serializing "terraform init" of the jobs sharing the plugin cache
+
+# batch: per job settings, a manifest entry can override any of them
+batch_defaults = {"actions": ["import", "create", "vars"], "mode": "script", "offline": False, "device_template": None,
+                  "layout": "flat", "format": "hcl", "prune": "off", "tfvars": False, "workers": 1}
+batch_import_dir = "import"     # batch: TF working directory of the import, under the job destination_dir
+# batch: per job provider credentials, set in the job's environment (an "env_file" of KEY=VALUE lines is read first)
+batch_credentials = {"manager_addr": "TF_VAR_MANAGER_ADDR", "manager_user": "TF_VAR_MANAGER_USER", "manager_pass": "TF_VAR_MANAGER_PASS"}
+
 # -------------------------------------------------------------------------------------------------
 def validate_content (name, id):
     return name and id
 
+# -------------------------------------------------------------------------------------------------
+def load_json (json_file):
+    """ orjson if available, raises the same exceptions as json.load (orjson.JSONDecodeError is a subclass) """
+
+    if orjson:
+        with open(json_file, "rb") as content_file:
+            return orjson.loads (content_file.read())
+
+    with open(json_file, "r") as content_file:
+        return json.load(content_file)
+
 # -------------------------------------------------------------------------------------------------
 def load_json_file (json_file):
 
@@ -31,8 +94,7 @@ def load_json_file (json_file):
         return None
 
     try:
-        with open(json_file, "r") as content_file:
-            return json.load(content_file)
+        return load_json (json_file)
     except OSError as exception:
         logging.warning (f"Unable to read template file {json_file} ({exception})")
     except json.decoder.JSONDecodeError as exception:
@@ -112,154 +174,527 @@ def find_field_type (content, sastre_type):
         return tf_type
 
 # -------------------------------------------------------------------------------------------------
-def find_field_by_name (content, field):
-    """ Loose value find. E.g. Id, no matter what it is ("definitionId", "listId", "policyId", "profileId", "siteId", "templateId") 
+def find_field_key (content, field):
+    """ Loose key find. E.g. Id, no matter what it is ("definitionId", "listId", "policyId", "profileId", "siteId", "templateId") 
         Hack: In config groups "Id" is called "id". And policy templates have "@rid" so cannot use lowercase
     """
 
-    for key, value in content.items():
-        # if re.search(field, key, re.IGNORECASE):
-        
-        if key == "id":
-            key = "Id"
-        if re.search(field, key):
-            return (value)
-    
-    return "Not found"
+    pattern = re.compile (field)
+    for key in content.keys():
+        if pattern.search ("Id" if key == "id" else key):
+            return key
+
+    return None
 
 # -------------------------------------------------------------------------------------------------
-def is_vedge_device (content):
+vedges = {"vedge-1000","vedge-2000","vedge-cloud","vedge-5000","vedge-ISR1100-6G","vedge-100-B","vedge-ISR1100-4G","vedge-100","vsmart","vedge-ISR1100-4GLTE",
+          "vedge-100-WM","vmanage","vedge-100-M","vedge-ISR1100X-6G","vedge-ISR1100X-4G"}
 
-    vedges = ["vedge-1000","vedge-2000","vedge-cloud","vedge-5000","vedge-ISR1100-6G","vedge-100-B","vedge-ISR1100-4G","vedge-100","vsmart","vedge-ISR1100-4GLTE",
-              "vedge-100-WM","vmanage","vedge-100-M","vedge-ISR1100X-6G","vedge-ISR1100X-4G", "vedge-cloud"]
+@functools.lru_cache (maxsize=None)
+def is_vedge_type (device_type):
+    """ device type string (device templates) may be a longer name containing the vEdge model """
 
-    for vedge in vedges:
-        if vedge in content.get ('deviceType',[]) or vedge in content.get ('device_type',[]):
+    return any (vedge in device_type for vedge in vedges)
+
+def is_vedge_device (content):
+
+    for field in ['deviceType', 'device_type']:
+        device_type = content.get (field, [])
+        if type (device_type) == str:
+            if is_vedge_type (device_type):
+                return True
+        elif not vedges.isdisjoint (device_type):
             return True
     if content.get('templateType',"").find("vedge") >= 0:
         return True
 
 # -------------------------------------------------------------------------------------------------
+unsupported_sastre = {"feature_profiles_sdwan_embedded_security", "feature_profiles_sdwan_policy_object", "policy_groups", "policy_templates_customapp"}
+
 def is_unsupported_import_type (sastre_type):
 
-    unsupported_sastre = ["feature_profiles_sdwan_embedded_security", "feature_profiles_sdwan_policy_object", "policy_groups", "policy_templates_customapp"]
     if sastre_type in unsupported_sastre:
         return True
 
 # -------------------------------------------------------------------------------------------------
-def skip_device_templates (object_type, object_name=""):
+skip_types = {"cli_device_template"}
+skip_templates = re.compile ('Default_|Factory_Default_')
 
-    skip_types = ["cli_device_template"]
-    skip_templates = ['Default_', 'Factory_Default_']
+def skip_device_templates (object_type, object_name=""):
 
     if object_type in skip_types:
         return True
     
-    for skip_item in skip_templates:
-        if re.match (skip_item, object_name):
-            return True
+    if skip_templates.match (object_name):
+        return True
     
 # -------------------------------------------------------------------------------------------------
+unsupported_feature_templates = {"appqoe", "virtual-application-utd"}
+
 def is_unsupported_feature_template (content):
 
-    unsupported = ["appqoe", "virtual-application-utd"]
-    if content.get('templateType',"") in unsupported:
+    if content.get('templateType',"") in unsupported_feature_templates:
         return True
 
 # -------------------------------------------------------------------------------------------------
+invalid_tf_chars = re.compile (r'[^-_a-zA-Z0-9]')
 
+@functools.lru_cache (maxsize=None)
 def normalized_tf_resource_name (name):
-    
-    letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    digits  = "0123456789"
+    """ TF rules: A name must start with a letter or underscore and may contain only letters, digits, underscores, and dashes.
+        prepend with _ if starts with - or digit
+    """
 
-    valid_tf_first = "_" + letters
-    valid_tf_chars = "_-" + letters + digits
-    
-    if name[0] not in valid_tf_first:
+    if not (name[0] == "_" or "a" <= name[0] <= "z" or "A" <= name[0] <= "Z"):
         name = '_' + name 
-    
-    name1 = ""
-    for c in name:
-        if c in valid_tf_chars:
-            name1 += c
+
+    return invalid_tf_chars.sub ("_", name)
+
+# -------------------------------------------------------------------------------------------------
+# Skip reasons reported by object_classifier, with the per object log message
+skip_messages = {
+    "invalid": "'{json_file}' does not seem to contain SD-WAN JSON details, skipping...",
+    "unsupported_type": "Skipping '{object_name}' due to '{sastre_type}' type not supported",
+    "explicit_skip": "Skipping device template '{object_name}' due to explicit skip",
+    "vedge": "Skipping feature template '{object_name}' due to no support for vedge devices",
+    "unsupported_feature_template": "Skipping feature template '{object_name}' due to not supported by the current TF provider",
+    "not_selected": "Skipping '{object_name}' as it is not used by the selected device templates",
+}
+
+# Helper class
+class object_classifier:
+    """ Classifies sastre inventory objects into (TF type, TF name, ID, skip reason)
+        Name and ID keys are learned once per key layout (same keys in the same order), skipped objects are counted per reason
+    """
+
+    def __init__ (self):
+        self.field_keys = {}
+        self.type_counts = {}
+        self.skip_counts = {}
+
+    def find_field (self, content, field):
+        # first matching key depends on the key order, same result as find_field_key per object
+        layout = (field, tuple (content.keys()))
+        if layout in self.field_keys:
+            key = self.field_keys[layout]
         else:
-            name1 += "_"
-    name = name1
-    
-    return name
+            key = find_field_key (content, field)
+            self.field_keys[layout] = key
+        return content[key] if key else "Not found"
+
+    def classify (self, content, sastre_type):
+        object_tf_type = find_field_type (content, sastre_type)
+        object_name = normalized_tf_resource_name (self.find_field (content, r'ame$'))
+        object_id = self.find_field (content, r'Id$')
+
+        # Safety check
+        if not validate_content (object_name, object_id):
+            reason = "invalid"
+        elif is_unsupported_import_type (sastre_type):
+            reason = "unsupported_type"
+        elif sastre_type == "device_templates" and skip_defaults and skip_device_templates (object_tf_type, object_name):
+            reason = "explicit_skip"
+        elif sastre_type == "feature_templates" and is_vedge_device (content):
+            reason = "vedge"
+        elif sastre_type == "feature_templates" and is_unsupported_feature_template (content):
+            reason = "unsupported_feature_template"
+        else:
+            reason = None
+
+        return (object_tf_type, object_name, object_id, reason)
+
+    def count (self, sastre_type, reason):
+        self.type_counts[sastre_type] = self.type_counts.get (sastre_type, 0) + 1
+        if reason:
+            self.skip_counts[reason] = self.skip_counts.get (reason, 0) + 1
+
+    def report (self):
+        for sastre_type, count in sorted (self.type_counts.items()):
+            logging.info (f"{sastre_type}: {count} objects")
+        for reason, count in sorted (self.skip_counts.items()):
+            logging.info (f"Skipped {count} objects: {reason}")
+
+        for sastre_type, count in self.type_counts.items():
+            metrics.count ("sastre_types", sastre_type, count)
+        for reason, count in self.skip_counts.items():
+            metrics.count ("skip_reasons", reason, count)
 
 # -------------------------------------------------------------------------------------------------
-def load_json_directory (json_directory, destination_dir):
+def classify_json_file (json_file, classifier):
+    """ Load sastre inventory file, returns sastre type and list of (TF type, TF name, ID, skip reason) """
 
-    text_tf   = mytext(f"{destination_dir}{target_fname_tf}", True) # first TF skeleton
-    text_bash = mytext(f"{destination_dir}{target_fname_bash}")     # bash import script
-    text_bash.add ("#!/bin/bash\n")  
+    sastre_type = os.path.basename (json_file).split(".")[0]
+    full_content = load_json_file (json_file)
+    if not full_content:
+        return (sastre_type, [])
 
-    json_files = next(os.walk(json_directory), (None, None, []))[2]
-    for json_file in json_files:
-        
-        full_content = load_json_file (f"{json_directory}/{json_file}")
-        if full_content:
-            sastre_type = json_file.split(".")[0]
-            for content in full_content:
-                object_tf_type = find_field_type (content, sastre_type)
-                # TF rules: A name must start with a letter or underscore and may contain only letters, digits, underscores, and dashes.
-                # prepend with _ if starts with - or digit
-                object_name = normalized_tf_resource_name (find_field_by_name (content, r'ame$'))
-                object_id = find_field_by_name (content, r'Id$')
-                
-                # Safety check
-                if not validate_content (object_name, object_id):
-                    logging.warning (f"'{json_file}' does not seem to contain SD-WAN JSON details, skipping...")
-                    continue
+    return (sastre_type, [classifier.classify (content, sastre_type) for content in full_content])
 
-                if is_unsupported_import_type(sastre_type):
-                    logging.debug (f"Skipping '{object_name}' due to '{sastre_type}' type not supported")
-                    continue
+# -------------------------------------------------------------------------------------------------
+def matches_any (name, patterns):
+    return any (fnmatch.fnmatchcase (name, pattern) for pattern in patterns)
 
-                if sastre_type == "device_templates" and skip_defaults and skip_device_templates (object_tf_type, object_name):
-                    logging.debug (f"Skipping device template '{object_name}' due to explicit skip")
-                    continue
+# -------------------------------------------------------------------------------------------------
+# ID key of the sastre detail files per top directory, a device template detail also holds the "policyId" of its policy
+detail_id_keys = {
+    "config_groups": "id",
+    "device_templates": "templateId",
+    "feature_profiles": "profileId",
+    "feature_templates": "templateId",
+    "policy_definitions": "definitionId",
+    "policy_lists": "listId",
+    "policy_templates": "policyId",
+}
 
-                if sastre_type == "feature_templates" and is_vedge_device (content):
-                    logging.debug (f"Skipping feature template '{object_name}' due to no support for vedge devices")
-                    continue
+def sastre_details (source_dir):
+    """ ID -> content of the object's sastre detail file (all files but inventory and device values) """
 
-                if sastre_type == "feature_templates" and is_unsupported_feature_template (content):
-                    logging.debug (f"Skipping feature template '{object_name}' due to not supported by the current TF provider")
-                    continue
+    id_keys = ["templateId", "policyId", "definitionId", "listId", "profileId", "id"]     # directories not in detail_id_keys
+    skip_dirs = [os.path.normpath (f"{source_dir}/inventory"), os.path.normpath (f"{source_dir}/device_templates/values")]
+
+    details = {}
+    for dirpath, dirnames, filenames in os.walk (source_dir):
+        if os.path.normpath (dirpath) in skip_dirs:
+            dirnames.clear()
+            continue
+        for json_file in filenames:
+            content = load_json_file (f"{dirpath}/{json_file}")
+            if type (content) != dict:
+                continue
+            detail_type = os.path.relpath (dirpath, source_dir).split (os.sep)[0]
+            if detail_type in detail_id_keys:
+                object_id = content.get (detail_id_keys[detail_type])
+            else:
+                object_id = next ((content[key] for key in id_keys if key in content), None)
+            if object_id:
+                details[object_id] = content
+
+    return details
+
+# -------------------------------------------------------------------------------------------------
+def sastre_reference_graph (source_dir):
+    """ ID -> set of IDs found anywhere in the object's sastre detail file """
+
+    graph = {}
+    for object_id, content in sastre_details (source_dir).items():
+        references = set (pattern_for_object_id.findall (json.dumps (content)))
+        references.discard (object_id)
+        graph[object_id] = references
+
+    return graph
+
+# -------------------------------------------------------------------------------------------------
+def sastre_selected_ids (source_dir, device_templates):
+    """ IDs of the device templates matching the name patterns and of everything they reference """
+
+    roots = []
+    for content in load_json_file (f"{source_dir}inventory/device_templates.json") or []:
+        if matches_any (content.get ("templateName", ""), device_templates):
+            roots.append (content.get ("templateId"))
+    if not roots:
+        raise SystemExit (f"No device templates matching {', '.join (device_templates)} found, exiting...")
 
-                logging.debug (f"Adding '{sastre_type}' object '{object_name}'")
-                # logging.debug (f'resource "sdwan_{object_tf_type}" "{object_name}" {{\n}}')
-                # logging.debug (f'terraform import sdwan_{object_tf_type}.{object_name} {object_id}')
-                text_tf.add (f'resource "sdwan_{object_tf_type}" "{object_name}" {{\n}}')
-                text_bash.add (f'terraform import sdwan_{object_tf_type}.{object_name} {object_id}')
+    selected_ids = dependency_closure (sastre_reference_graph (source_dir), roots)
+    logging.info (f"{len (roots)} device templates selected, {len (selected_ids)} objects in their dependency closure")
+
+    return selected_ids
+
+# -------------------------------------------------------------------------------------------------
+def write_import_files (import_items, destination_dir, import_mode, existing_ids=None):
+    """ Script mode: TF skeleton + bash script with one "terraform import" per object
+        Blocks mode: single imports.tf with "import {}" blocks, TF generates the skeleton itself during plan
+        Objects with IDs in existing_ids are already in tfstate: skeleton only, no import
+    """
+
+    existing_ids = existing_ids or set()
+
+    text_tf   = mytext(f"{destination_dir}{target_fname_tf}", import_mode == "script")    # first TF skeleton
+    text_bash = mytext(f"{destination_dir}{target_fname_bash}")                             # bash import script
+    text_imports = mytext(f"{destination_dir}{target_fname_imports}", import_mode == "blocks")
+
+    if import_mode == "blocks":
+        for (object_address, object_id) in import_items:
+            text_imports.add (f'import {{\n  to = {object_address}\n  id = "{object_id}"\n}}\n')
+        text_imports.write()
+        return
+
+    # import_object: "terraform import" with retries and backoff for transient errors, completed imports go to the journal,
+    # with --metrics start/end time of every attempt goes to the timings file
+    text_bash.add ("#!/bin/bash\n")
+    if metrics.enabled:
+        text_bash.add (f'rm -f {target_fname_timings}')
+    [start, timing] = ['    start=$(date +%s.%N)\n', f'    echo "$start $(date +%s.%N) $result $1" >> {target_fname_timings}\n'] if metrics.enabled else ["", ""]
+    text_bash.add (f'failed=0\nimport_object () {{\n  local attempt result start delays=({" ".join (str (delay) for delay in retry_delays ())})\n'
+                   f'  for attempt in $(seq 0 {import_retries}); do\n{start}    output=$(terraform import "$1" "$2" 2>&1)\n    result=$?\n{timing}'
+                   f'    echo "$output"\n'
+                   f'    if [ $result -eq 0 ]; then\n      echo "{{\\"address\\": \\"$1\\", \\"id\\": \\"$2\\"}}" >> {target_fname_journal}\n      return 0\n    fi\n'
+                   f"    echo \"$output\" | grep -Eqi '{transient_errors}' || break\n"
+                   f'    [ $attempt -lt {import_retries} ] && sleep ${{delays[$attempt]}}\n  done\n  failed=$((failed + 1))\n}}\n')
+    for (object_address, object_id) in import_items:
+        [object_type, object_name] = object_address.split(".", 1)
+        text_tf.add (f'resource "{object_type}" "{object_name}" {{\n}}')
+        if object_id not in existing_ids:
+            text_bash.add (f'import_object {object_address} {object_id}')
+    text_bash.add ('\nexit $((failed > 0 ? 1 : 0))')
 
     text_bash.write()
     text_tf.write()
 
 # -------------------------------------------------------------------------------------------------
-def terraform_import (source_dir, destination_dir, use_api):
+def load_json_directory (json_directory, workers=1, cache=None, selected_ids=None):
+    """ Go through the sastre inventory, returns ([(TF address, ID)], IDs of all the objects in the backup), see write_import_files
+        workers > 1: files are loaded and classified in a process pool, results keep the file order
+        cache: unchanged files are served from the inventory cache
+        selected_ids: only import these objects (dependency closure of selected device templates), the others are
+            still in the returned IDs
+    """
 
-    # Process vManage API data
-    load_json_directory (source_dir + "/inventory", destination_dir)
+    import_items = []
+    inventory_ids = set()
+
+    classifier = object_classifier ()
+
+    json_files = next(os.walk(json_directory), (None, None, []))[2]
+    json_paths = [f"{json_directory}/{json_file}" for json_file in json_files]
+    results = [cache.lookup_records (json_path) if cache else None for json_path in json_paths]
+
+    missing = [idx for idx, result in enumerate (results) if result is None]
+    missing_paths = [json_paths[idx] for idx in missing]
+    if workers > 1 and len (missing_paths) > 1:
+        with ProcessPoolExecutor (max_workers=workers) as executor:
+            loaded = list (executor.map (classify_json_file, missing_paths, repeat (classifier)))
+    else:
+        loaded = [classify_json_file (json_path, classifier) for json_path in missing_paths]
+
+    for idx, (sastre_type, records) in zip (missing, loaded):
+        results[idx] = (sastre_type, records)
+        if cache and records:
+            cache.store_records (json_paths[idx], sastre_type, records)
+    if cache:
+        cache.commit ()
+
+    for json_file, (sastre_type, records) in zip (json_files, results):
+        for (object_tf_type, object_name, object_id, reason) in records:
+            if not reason:
+                inventory_ids.add (object_id)
+            if not reason and selected_ids is not None and object_id not in selected_ids:
+                reason = "not_selected"
+            classifier.count (sastre_type, reason)
+
+            if reason == "invalid":
+                logging.warning (skip_messages[reason].format (json_file=json_file))
+                continue
+            if reason:
+                logging.debug (skip_messages[reason].format (object_name=object_name, sastre_type=sastre_type))
+                continue
+
+            logging.debug (f"Adding '{sastre_type}' object '{object_name}'")
+            # logging.debug (f'resource "sdwan_{object_tf_type}" "{object_name}" {{\n}}')
+            # logging.debug (f'terraform import sdwan_{object_tf_type}.{object_name} {object_id}')
+            import_items.append ((f"sdwan_{object_tf_type}.{object_name}", object_id))
+
+    classifier.report ()
+
+    return import_items, inventory_ids
+
+# -------------------------------------------------------------------------------------------------
+def terraform_import_blocks ():
+    """ Import everything in one plan/apply run using imports.tf, TF writes the resource skeleton """
+
+    # -generate-config-out refuses to overwrite an existing file
+    os.system(f"rm -f {local_dir}/{target_fname_tf}")
 
-    # Init TF: clean up old tfstate and initialize provider
-    os.system(f"mv {local_dir}/terraform.tfstate {local_dir}/terraform.tfstate.~~~bck 2>/dev/null")
+    # plan may report errors in the generated config, but the config file is still written
+    result = metrics.system(f"terraform plan -generate-config-out={target_fname_tf} -out={target_fname_plan}")
+    if result != 0:
+        logging.error (f'Terraform plan failure: {result}, check {target_fname_tf} and {target_fname_imports}, exiting...')
+        exit (1)
+
+    result = metrics.system(f"terraform apply {target_fname_plan}")
+    if result != 0:
+        logging.error (f'Terraform apply failure: {result}, exiting...')
+        exit (1)
+
+    os.system(f"rm -f {local_dir}/{target_fname_plan}")
+
+# -------------------------------------------------------------------------------------------------
+def load_tfstate_ids (tf_file):
+    """ ID -> TF address (with module prefix and instance key) of the managed resources in the existing tfstate """
+
+    # first incremental run: no tfstate yet, nothing to report
+    if not os.path.exists (tf_file):
+        logging.info (f"No existing {tf_file}, importing all objects")
+        return {}
+
+    tfstate = load_tf_file (tf_file)
+    if not tfstate:
+        return {}
+
+    state_ids = {}
+    for resource in tfstate.get("resources", []):
+        # data sources are not imported objects
+        if resource.get("mode", "managed") != "managed":
+            continue
+        module = f'{resource["module"]}.' if resource.get("module") else ""
+        for item in resource["instances"]:
+            id = item["attributes"].get('id')
+            index_key = item.get("index_key")
+            instance = "" if index_key is None else f"[{json.dumps (index_key)}]"
+            state_ids[id] = f'{module}{resource.get("type")}.{resource.get("name")}{instance}'
+
+    return state_ids
+
+# -------------------------------------------------------------------------------------------------
+def terraform_state_rm (addresses, batch_size=100):
+    """ Remove resources from tfstate, in batches to keep command line length sane """
+
+    for idx in range(0, len(addresses), batch_size):
+        batch = " ".join (addresses[idx:idx + batch_size])
+        result = metrics.system(f"terraform state rm {batch}")
+        if result != 0:
+            logging.error (f'Terraform state rm failure: {result}, exiting...')
+            exit (1)
+
+# -------------------------------------------------------------------------------------------------
+def terraform_import (source_dir, destination_dir, use_api, import_mode="script", jobs=1, incremental=False, workers=1, cache=None,
+                      device_templates=None, offline=False, schema_check=None, restart=False, upgrade=False, plugin_dir=None):
+    """ offline: mapped object types are written to tfstate straight from the sastre detail files, see tf_synth,
+            only the TF types which passed the schema check (report in destination_dir)
+        schema_check: only compare the offline state with this tfstate from a real import, nothing is imported
+        Script mode keeps a journal of completed imports until the run succeeds, the next run resumes from it
+        (keeping tfstate) unless restart is set
+        "terraform init" runs only if the installed provider does not satisfy tf_header (or upgrade is set),
+        plugin_dir: install providers from this filesystem mirror instead of the registry
+    """
+
+    # TF would plan to destroy objects in tfstate which are not in the generated config
+    if incremental and import_mode == "blocks":
+        raise SystemExit ("Incremental import is only supported in 'script' mode")
+    if offline and import_mode == "blocks":
+        raise SystemExit ("Offline import is only supported in 'script' mode")
+    # one plan/apply run: no shards, no journal to discard
+    if import_mode == "blocks" and jobs > 1:
+        raise SystemExit ("--jobs is only supported in 'script' mode, 'blocks' mode imports in a single terraform apply")
+    if import_mode == "blocks" and restart:
+        raise SystemExit ("--restart is only supported in 'script' mode, 'blocks' mode keeps no journal")
+
+    # The closure comes from the sastre detail files, the API fetch only saves the inventory index
+    if use_api and device_templates:
+        raise SystemExit ("--device_template needs the sastre detail files, which --api does not fetch: "
+                          "use a sastre backup as source_dir or import all device templates, exiting...")
+
+    # Live API data is saved in the sastre layout and processed the same way
+    if use_api:
+        metrics.phase ("fetch_api")
+        fetch_inventory (api_client (), source_dir)
+
+    # Only what the selected device templates need
+    metrics.phase ("load_inventory")
+    selected_ids = sastre_selected_ids (source_dir, device_templates) if device_templates else None
+
+    # Process vManage API data
+    (import_items, inventory_ids) = load_json_directory (source_dir + "/inventory", workers, cache, selected_ids)
+    all_items = import_items
+
+    # Nothing is imported: no import files, tfstate and journal are left alone
+    if schema_check:
+        metrics.phase ("schema_check")
+        synthesized, _ = synthesize_resources (import_items, sastre_details (source_dir))
+        report = check_schema_coverage (synthesized, schema_check)
+        with open(f"{destination_dir}{target_fname_schema}", "w") as file:
+            json.dump (report, file, indent=2)
+        logging.info (f"Schema coverage report written to {destination_dir}{target_fname_schema}")
+        return
+
+    # Unfinished previous run: objects in its journal or already in tfstate are not imported again
+    journal = import_journal (f"{local_dir}/{target_fname_journal}")
+    if restart:
+        journal.remove ()
+    resume = import_mode == "script" and journal.exists ()
+    if resume:
+        recover_shards (f"{local_dir}/{tfstate_file}")
+
+    # Incremental: keep tfstate and only import objects with IDs not seen there yet
+    state_ids = load_tfstate_ids (f"{local_dir}/{tfstate_file}") if incremental or resume else {}
+    done_ids = set (state_ids.keys()) | set (journal.completed().keys() if resume else [])
+
+    if incremental:
+        # objects outside the selected closure are still in the backup, they are not stale
+        stale = [address for id, address in state_ids.items() if id not in inventory_ids]
+        import_items = [item for item in import_items if item[1] not in done_ids]
+        logging.info (f"Incremental import: {len(import_items)} new objects, {len(stale)} objects no longer in the backup")
+    elif resume:
+        import_items = [item for item in import_items if item[1] not in done_ids]
+        logging.info (f"Resuming unfinished import: {len(done_ids)} objects done, {len(import_items)} left")
+    else:
+        # Init TF: clean up old tfstate and initialize provider
+        os.system(f"mv {local_dir}/terraform.tfstate {local_dir}/terraform.tfstate.~~~bck 2>/dev/null")
+
+    # Offline: synthesized objects get the skeleton but no import
+    if not offline:
+        write_import_files (all_items, destination_dir, import_mode, done_ids)
+
+    # Offline: synthesized objects are merged into tfstate (on top of the existing one if incremental)
+    if offline:
+        metrics.phase ("synthesize_state")
+        tf_types = verified_types (f"{destination_dir}{target_fname_schema}")
+        if not tf_types:
+            logging.warning (f"Offline import: no object types verified in {destination_dir}{target_fname_schema}, "
+                             f"run 'import --schema_check TFSTATE' against a real import first, importing all objects")
+        synthesized, import_items = synthesize_resources (import_items, sastre_details (source_dir), tf_types)
+        synthesized_ids = set (resource["instances"][0]["attributes"]["id"] for resource in synthesized)
+        logging.info (f"Offline import: {len(synthesized)} objects written to tfstate, {len(import_items)} left for terraform import")
+
+        write_import_files (all_items, destination_dir, import_mode, done_ids | synthesized_ids)
+        write_tfstate (synthesized, f"{local_dir}/{tfstate_file}.offline")
+        merge_states ([f"{local_dir}/{tfstate_file}.offline"], f"{local_dir}/{tfstate_file}")
     
     # This is needed in case provider is not activated, or is outdated
-    tf_init_result = os.system(f"terraform init -upgrade")
-    if tf_init_result != 0:
-        logging.error (f'Terraform init failure: {tf_init_result}, exiting...')
-        exit (1)
+    metrics.phase ("terraform_init")
+    with file_lock (init_lock):
+        init_reason = "upgrade requested" if upgrade else terraform_init_reason (tf_provider_source, tf_provider_version, local_dir)
+        if init_reason:
+            logging.info (f"Running terraform init: {init_reason}")
+            plugin_option = f" -plugin-dir={plugin_dir}" if plugin_dir else ""
+            tf_init_result = metrics.system(f"terraform init -upgrade{plugin_option}")
+            if tf_init_result != 0:
+                logging.error (f'Terraform init failure: {tf_init_result}, exiting...')
+                exit (1)
+        else:
+            logging.info (f"Skipping terraform init: installed {tf_provider_source} provider satisfies '{tf_provider_version}' "
+                          f"(binary not checked against the lock file hashes, use --upgrade to reinstall)")
+
+    if incremental and stale:
+        metrics.phase ("terraform_state_rm")
+        terraform_state_rm (stale)
+
+    metrics.phase ("terraform_import")
+    if import_mode == "blocks":
+        terraform_import_blocks ()
+        return
+
+    journal.start ()
+
+    # Parallel shards, each with its own state file, merged into terraform.tfstate at the end
+    if jobs > 1:
+        failed = run_import_shards (import_items, jobs, f"{local_dir}/{tfstate_file}", journal=journal)
+        if failed:
+            for (object_address, object_id) in failed:
+                logging.error (f'Unable to import {object_address} ({object_id})')
+            logging.error (f'{len(failed)} objects failed to import, run again to resume, exiting...')
+            exit (1)
+        journal.remove ()
+        return
 
     # Execute import script and populate tfstate with live data
     os.system(f"chmod +x {target_fname_bash}")
     result = os.system(f"{local_dir}/{target_fname_bash}")
+    if metrics.enabled:
+        metrics.load_command_timings (f"{local_dir}/{target_fname_timings}")
     if result != 0:
-        logging.error (f'Error executing terraform import script, exiting...')
+        logging.error (f'Error executing terraform import script, run again to resume, exiting...')
         exit (1)
+    journal.remove ()
 
     # os.system(f"rm {destination_dir}{target_fname_tf}")
 
@@ -269,8 +704,7 @@ def terraform_import (source_dir, destination_dir, use_api):
 # -------------------------------------------------------------------------------------------------
 def load_tf_file (tf_file):
     try:
-        with open(tf_file, "r") as content_file:
-            return json.load(content_file)
+        return load_json (tf_file)
     except OSError as exception:
         print (f"Unable to read device template {tf_file} ({exception})")
     except json.decoder.JSONDecodeError as exception:
@@ -278,6 +712,134 @@ def load_tf_file (tf_file):
     except:
         return None
 
+# -------------------------------------------------------------------------------------------------
+# Helper class
+number_chars = set ("0123456789+-.eE")
+
+class json_stream_reader:
+    """ Incremental JSON reader: decodes one value at a time from a file, buffering only what's needed """
+
+    def __init__ (self, content_file):
+        self.file = content_file
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill (self):
+        # read size grows with the buffer so that huge single values are not re-decoded too many times
+        chunk = self.file.read (max (stream_chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek (self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill ():
+                return ""
+
+    def expect (self, char):
+        if self.peek () != char:
+            raise json.decoder.JSONDecodeError (f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def value (self):
+        self.peek ()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode (self.buffer, self.pos)
+                # a number ending the buffer may continue in the next chunk, even after what was decoded ("1." + "5e3")
+                tail = end
+                if type (value) in (int, float):
+                    while tail < len(self.buffer) and self.buffer[tail] in number_chars:
+                        tail += 1
+                if tail < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.decoder.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill ()
+
+# -------------------------------------------------------------------------------------------------
+def stream_tf_resources (tf_file, header=None):
+    """ Yield tfstate resources one by one, other top level keys are decoded and dropped (or saved to header) """
+
+    with open(tf_file, "r") as content_file:
+        reader = json_stream_reader (content_file)
+        reader.expect ("{")
+        while reader.peek () != "}":
+            key = reader.value ()
+            reader.expect (":")
+            if key == "resources":
+                reader.expect ("[")
+                while reader.peek () != "]":
+                    yield reader.value ()
+                    if reader.peek () == ",":
+                        reader.expect (",")
+                reader.expect ("]")
+            elif header is not None:
+                header[key] = reader.value ()
+            else:
+                reader.value ()
+            if reader.peek () == ",":
+                reader.expect (",")
+
+# -------------------------------------------------------------------------------------------------
+def tfstate_resources (tf_file, streaming=False):
+    """ Returns a function to iterate over tfstate resources
+        streaming: the file is re-read on every call, memory use does not depend on the tfstate size
+    """
+
+    if streaming:
+        if not os.path.isfile (tf_file):
+            raise SystemExit (f"Cannot load {tfstate_file} file")
+        return lambda: stream_tf_resources (tf_file)
+
+    tfstate = load_tf_file (tf_file)
+    if not tfstate:
+        raise SystemExit (f"Cannot load {tfstate_file} file")
+    return lambda: iter (tfstate["resources"])
+
+# -------------------------------------------------------------------------------------------------
+def tfstate_header (tf_file):
+    """ tfstate top level keys before "resources" (version, terraform_version, serial, lineage, outputs) """
+
+    header = {}
+    next (stream_tf_resources (tf_file, header), None)
+    return header
+
+# -------------------------------------------------------------------------------------------------
+def tfstate_resource_group (resource):
+    """ device templates need to be processed first so we know which feature templates are in use """
+
+    if resource.get('type') in [tf_type_device_template, "sdwan_application_aware_routing_policy_definition"]:
+        if is_vedge_device (resource.get('instances',[[]])[0].get('attributes',{})):
+            return None
+        return "devices"
+    elif resource.get('type') == tf_type_device_cli:
+        return None
+    else:
+        return "rest"
+
+# -------------------------------------------------------------------------------------------------
+def object_stream (id):
+    """ Stream of a known object, by its TF type unless moved to prune_stream """
+
+    return prune_stream if id in pruned_ids else get_stream (all_IDs.get_type (id))
+
+def resource_stream (resource):
+    if pruned_ids and resource["instances"][0]["attributes"].get('id') in pruned_ids:
+        return prune_stream
+    return get_stream (resource["type"])
+
 # -------------------------------------------------------------------------------------------------
 def get_stream (tf_type):
 
@@ -292,209 +854,538 @@ def get_stream (tf_type):
 #     return key.replace ('"', '').lstrip()
 
 # -------------------------------------------------------------------------------------------------
+sort_seq = ["id", "name", "description", "device_types", "vpn_id", "interface_name", "interface_description", "address_variable", "dhcp", 
+            "match_entries", "action_entries"]
+sort_rank = {item: idx for idx, item in enumerate(sort_seq)}
+
 def SortFunction (item):
-    
-    sort_seq = ["id", "name", "description", "device_types", "vpn_id", "interface_name", "interface_description", "address_variable", "dhcp", 
-                "match_entries", "action_entries"]
-    
-    try:
-        idx = str(sort_seq.index (item)+1000)
-    except:
-        idx = "9999"
-    return idx + item
+    """ Known keys first in sort_seq order, the rest alphabetically """
 
+    return (sort_rank.get (item, len(sort_seq)), item)
 
 # -------------------------------------------------------------------------------------------------
-def id_to_name (line):
-    # input: any TF line with id
-    # return: id is replace with the name, if it's known
+def id_to_name (value):
+    """ in: any string value; out: TF resource name if the value is a known object ID, otherwise None
+        "streams" layout: objects from other streams (root modules) are referenced through data sources
+    """
 
-    pattern_for_object_id = '(.*)(\w{8}-\w{4}-\w{4}-\w{4}-\w{12})(.*)'
+    if render_record is not None:
+        record_ref (value)
 
-    result = re.match(pattern_for_object_id, line)
-    if result:
-        indent = result.group(1)
-        value = result.group(2)
-        tail = result.group(3)
-        name = all_IDs.get_name (value) 
-        line = indent + name + tail
+    if value in all_IDs.dict and pattern_for_object_id.fullmatch (value):
+        name = all_IDs.get_name (value)
+        if current_partition and object_stream (value) != current_partition:
+            data_sources.setdefault (current_partition, {})[name] = value
+            if render_record is not None:
+                render_record["data_sources"][name] = value
+            name = f"data.{name}"
+        return name
 
-    return line
+    return None
 
 # -------------------------------------------------------------------------------------------------
-def parse_tf_line (tf_line):
-    # input: TF line e.g. 
-    #       "policy_id": "693db1a3-9f6f-49a2-8c72-76bca3495bb5",
-    #                "id": "26c78907-6d10-4dc3-8b47-b58197b7725a",
-    # return:
-    #       indent, key, value, name: ['    ', 'id', '693db1a3-9f6f-49a2-8c72-76bca3495bb5', 'SITE_BFD'/693db1a3-9f6f-49a2-8c72-76bca3495bb5]
+def id_facts (value):
+    """ What the rendering of an ID depends on: [TF name, stream] of the object, None if unknown """
 
-    pattern_for_key_object  = '( *)"(.*)": *"(.*)"(.*)'  # "id": "26c78907-6d10-4dc3-8b47-b58197b7725a",
-    pattern_for_object_id = '\w{8}-\w{4}-\w{4}-\w{4}-\w{12}'
-    pattern_for_key = '( *)"(.*)": (.*)'      # "id": [
+    item = all_IDs.dict.get (value)
+    return [item["name"], object_stream (value)] if item else None
 
-    result = re.match(pattern_for_key_object,  tf_line)
-    if result:
-        indent = result.group(1)
-        key = result.group(2)
-        value = result.group(3)
-        # is_id = re.match (pattern_for_object_id, value)
-        # name = all_IDs.get_name (value) if is_id else value
-        name = id_to_name (value)
-        # tail = result.group(3)
-        return [indent, key, value, name]
+def record_ref (value):
+    if pattern_for_object_id.fullmatch (value):
+        render_record["refs"][value] = id_facts (value)
 
-    result = re.match(pattern_for_key,  tf_line)
-    if result:
-        indent = result.group(1)
-        key = result.group(2)
-        value = result.group(3)
-        return [indent, key, value]
+# -------------------------------------------------------------------------------------------------
+def render_hcl (value, res_type, indent, lines, prefix="", comma=""):
+    """ Render JSON value from tfstate as HCL lines, walking dicts and lists directly
+        prefix: "key = " for dict items, "" for list elements; comma: separator after the value
+    """
 
-    tf_line = id_to_name (tf_line)
+    if type (value) in (list, dict):
+        if not value:
+            lines.append (f"{indent}{prefix}{json.dumps (value)}{comma}")
+            return
 
-    return [tf_line]
+        if type (value) == list:
+            [open_char, close_char] = ["[", "]"]
+            items = [("", sub_value) for sub_value in value]
+        else:
+            [open_char, close_char] = ["{", "}"]
+            items = [(f"{key} = ", sub_value) for key, sub_value in value.items()]
+
+        lines.append (f"{indent}{prefix}{open_char}")
+        last = len (items) - 1
+        for idx, (sub_prefix, sub_value) in enumerate (items):
+            # null dict items are dropped, comma still follows the JSON item position
+            if sub_value is None and sub_prefix:
+                continue
+            render_hcl (sub_value, res_type, indent + "  ", lines, sub_prefix, "," if idx < last else "")
+        lines.append (f"{indent}{close_char}{comma}")
+
+    elif type (value) == str:
+        name = id_to_name (value)
+        if not prefix:
+            lines.append (f"{indent}{json.dumps (name or value)}{comma}")
+        # hacking for device templates, replace ID with TF obj reference
+        # "id": "1039812038" -> "id" = sdwan_cedge_aaa_feature_template.Global_AAA.id,
+        elif name and res_type == tf_type_device_template:
+            lines.append (f"{indent}{prefix}{name}.id,")
+            lines.append (f"{indent}version = {name}.version,")
+        elif name:
+            lines.append (f"{indent}{prefix}{name},")
+        else:
+            lines.append (f"{indent}{prefix}{json.dumps (value)},")
+
+    else:
+        lines.append (f"{indent}{prefix}{json.dumps (value)}{comma}")
 
 # -------------------------------------------------------------------------------------------------
-def tfstate_process_list (text, res_type):
+def tfstate_process_list (value, res_type):
     """ process top level multiline list elements """
 
-    out = mytext()
-    lines = text.split("\n")
-    for line in lines:
-        if ": null" in line:
+    lines = []
+    render_hcl (value, res_type, "  ", lines)
+
+    return "\n".join (lines).lstrip()
+
+# -------------------------------------------------------------------------------------------------
+def process_tfstate_file (resources, texts, state_slices=None, manifest=None, executor=None):
+    """ go through the tfstate file and extract non-default values
+        state_slices: "streams" layout, stream -> mytext collecting the stream's tfstate resources
+        manifest: render_manifest, unchanged resources are taken from the previous run
+        executor: process pool (see render_worker_init), resources are rendered there in windows of render_window
+    """
+
+    global current_partition
+
+    window = []
+    for resource in resources:
+        stream = resource_stream (resource)
+
+        if state_slices is not None:
+            current_partition = stream
+            if stream not in state_slices:
+                state_slices[stream] = []
+            state_slices[stream].append (json.dumps (resource, indent=2))
+
+        if executor:
+            window.append (resource)
+            if len (window) >= render_window:
+                render_parallel (window, texts, manifest, executor)
+                window = []
             continue
-        # hacking for device templates, replace ID with TF obj reference
-        # "id": "1039812038" -> "id" = sdwan_cedge_aaa_feature_template.Global_AAA.id,
-        pline = parse_tf_line (line)
-        if len (pline) == 4:
-            [ indent, key, value, name ] = pline
-            # if res_type == tf_type_device_template and key == 'id' and name != value:  
-            if res_type == tf_type_device_template and name != value:  
-                out.add (f'  {indent}{key} = {name}.id,')
-                out.add (f'  {indent}version = {name}.version,')
-            elif name != value:  # replace id with the name
-                out.add (f'  {indent}{key} = {name},')
-            else:
-                out.add (f'  {indent}{key} = "{name}",')
-        elif len (pline) == 3:
-            [ indent, key, value ] = pline
-            out.add (f'  {indent}{key} = {value}')
-        else:  
-            out.add (f'  {pline[0]}')
 
-    return out.text.rstrip("\n")
+        texts.add (stream, render_cached (resource, manifest) if manifest else render_resource (resource))
+
+    if window:
+        render_parallel (window, texts, manifest, executor)
+
+# -------------------------------------------------------------------------------------------------
+def render_worker_init (ids, streams_layout, pruned, format, metrics_enabled=False):
+    """ Process pool initializer: read-only copy of the ID map """
+
+    global all_IDs, render_streams, pruned_ids, output_format
+
+    metrics.enabled = metrics_enabled
+    all_IDs = all_id_class()
+    all_IDs.dict = ids
+    render_streams = streams_layout
+    pruned_ids = pruned
+    output_format = format
+
+def render_batch (resources, record_refs):
+    """ Pool task: returns ([(text, data sources, ID facts or None)] per resource, timers of the batch) """
+
+    global current_partition, render_record
+
+    metrics.timers = {}
+    results = []
+    for resource in resources:
+        current_partition = resource_stream (resource) if render_streams else None
+        render_record = {"refs": {}, "data_sources": {}}
+        text = render_resource (resource)
+        results.append ((text, render_record["data_sources"], render_record["refs"] if record_refs else None))
+    render_record = None
+
+    return (results, metrics.timers)
+
+def render_parallel (window, texts, manifest, executor):
+    """ Render the resources not found in the manifest in the pool, add all texts in the original order """
+
+    jobs = []
+    misses = []
+    for resource in window:
+        stream = resource_stream (resource)
+        text = key = hash = None
+        if manifest:
+            (key, hash) = manifest_key (resource)
+            entry = manifest.lookup (key, hash, id_facts)
+            if entry:
+                text = entry["text"]
+                if entry["data_sources"]:
+                    data_sources.setdefault (stream, {}).update (entry["data_sources"])
+        if text is None:
+            misses.append (resource)
+        jobs.append ((stream, key, hash, text))
+
+    batches = [misses[idx:idx + render_batch_size] for idx in range(0, len (misses), render_batch_size)]
+    def merged (batch_results):
+        # timers of the workers go to the main process metrics
+        for (results, timers) in batch_results:
+            for name, seconds in timers.items():
+                metrics.add_time (name, seconds)
+            yield from results
+
+    rendered = merged (executor.map (render_batch, batches, repeat (manifest is not None)))
+
+    for (stream, key, hash, text) in jobs:
+        if text is None:
+            (text, sources, refs) = next (rendered)
+            if sources:
+                data_sources.setdefault (stream, {}).update (sources)
+            if manifest:
+                manifest.store (key, hash, text, refs, sources)
+        texts.add (stream, text)
 
 # -------------------------------------------------------------------------------------------------
-def process_tfstate_file (resources, texts):
-    """ go through the tfstate file and extract non-default values """
+def manifest_key (resource):
+    """ (TF address, hash of the tfstate content) """
+
+    return (f'{resource["type"]}.{resource["name"]}', hashlib.sha256 (json.dumps (resource).encode()).hexdigest())
+
+def render_cached (resource, manifest):
+    """ Rendered resource from the manifest if neither its tfstate content nor the referenced objects changed """
+
+    global render_record
+
+    (key, hash) = manifest_key (resource)
+    entry = manifest.lookup (key, hash, id_facts)
+    if entry:
+        for name, id in entry["data_sources"].items():
+            data_sources.setdefault (current_partition, {})[name] = id
+        return entry["text"]
+
+    render_record = {"refs": {}, "data_sources": {}}
+    text = render_resource (resource)
+    manifest.store (key, hash, text, render_record["refs"], render_record["data_sources"])
+    render_record = None
+
+    return text
+
+# -------------------------------------------------------------------------------------------------
+def render_resource (resource):
+    """ HCL text of one tfstate resource """
+
+    if output_format == "json":
+        return render_resource_json (resource)
 
     commented = ["id"]
     skipped = [None, "template_type"]
 
-    for resource in resources:
-        resource_type = resource["type"]
-        stream = get_stream (resource_type)
+    resource_type = resource["type"]
+    lines = [f'resource \"{resource_type}\" \"{resource["name"]}\" {{']
 
-        texts.add (stream, f'resource \"{resource_type}\" \"{resource["name"]}\" {{')
+    for item in resource["instances"]:
 
-        for item in resource["instances"]:
+        sort_start = time.perf_counter () if metrics.enabled else 0
+        keylist = list(item["attributes"].keys())
+        keylist.sort (key = SortFunction)
+        if metrics.enabled:
+            metrics.add_time ("sort_attributes", time.perf_counter () - sort_start)
+        for key in keylist:
+            value = item["attributes"][key]
+            
+            if value in skipped or key in skipped:
+                continue
 
-            keylist = list(item["attributes"].keys())
-            keylist.sort (key = SortFunction)
-            for key in keylist:
-                value = item["attributes"][key]
-                
-                if value in skipped or key in skipped:
-                    continue
+            # comment = "# " if key in commented else ""
+            if key == "id":
+                key = "# " + key
+
+            # json formats to TF formats
+            if type (value) == bool:
+                value = str (value).lower()
+            # if type (value) == int:
+            #     value = str (value)
+
+            if type (value) == str:
+                value = value.replace("\n","\\n")   # CLI templates come with "\n" or "\r\n"
+                value = value.replace("\r","")
+                # value = value.replace("\\","\\\\")  # escape backslash
+                if render_record is not None:
+                    record_ref (value)
+                value = f'"{all_IDs.get_name (value)}"' 
+            if type (value) == list:
+                # simple list - keep 1 liner
+                if value and type (value[0]) == str:
+                    value = str(value).replace("'",'"')
+                # complex structure - render HCL from the structure
+                else:
+                    value = tfstate_process_list (value, resource_type)
+            
+            lines.append (f"  {key} = {value}")
+    lines.append ("}\n")
+
+    return "\n".join (lines)
 
-                # comment = "# " if key in commented else ""
-                if key == "id":
-                    key = "# " + key
-
-                # json formats to TF formats
-                if type (value) == bool:
-                    value = str (value).lower()
-                # if type (value) == int:
-                #     value = str (value)
-
-                if type (value) == str:
-                    value = value.replace("\n","\\n")   # CLI templates come with "\n" or "\r\n"
-                    value = value.replace("\r","")
-                    # value = value.replace("\\","\\\\")  # escape backslash
-                    value = f'"{all_IDs.get_name (value)}"' 
-                if type (value) == list:
-                    # simple list - keep 1 liner
-                    if type (value[0]) == str:
-                        value = str(value)
-                    # complex structure - process line by line
-                    else:
-                        # keylist = value.keys()
-                        # keylist.sort (key = SortFunction)
-                        # sorted_value = {key:value[key] for key in value.keys()}
-                        value = tfstate_process_list (json.dumps(value, indent=2), resource_type)
-
-                    value = value.replace("'",'"').lstrip()
-                
-                texts.add (stream, f"  {key} = {value}")
-        texts.add (stream, "}\n")
-
-# -------------------------------------------------------------------------------------------------
-def terraform_create (source_dir, destination_dir):
-
-    global all_IDs
+# -------------------------------------------------------------------------------------------------
+def render_resource_json (resource):
+    """ Terraform JSON syntax of one tfstate resource, single line {"<type>": {"<name>": {attributes}}}
+        Same attributes and ID resolution as render_resource, the object ID goes to a "//" comment
+    """
 
-    all_IDs = all_id_class()
+    skipped = [None, "template_type"]
 
-    tfstate = load_tf_file (f"{source_dir}{tfstate_file}")
-    if not tfstate:
-        raise SystemExit (f"Cannot load {tfstate_file} file")
+    resource_type = resource["type"]
+    body = {}
+    for item in resource["instances"]:
+        for key in sorted (item["attributes"].keys(), key = SortFunction):
+            value = item["attributes"][key]
+            if value in skipped or key in skipped:
+                continue
+            if key == "id":
+                body["//"] = f"id = {value}"
+                continue
+            # top level: string IDs become the quoted TF name, string lists are kept as they are
+            if type (value) == str:
+                if render_record is not None:
+                    record_ref (value)
+                body[key] = json_literal (all_IDs.get_name (value).replace ("\r", ""))
+            elif type (value) == list and value and type (value[0]) == str:
+                body[key] = [json_literal (sub_value) if type (sub_value) == str else sub_value for sub_value in value]
+            else:
+                body[key] = json_value (value, resource_type)
 
-    # Create ID -> Name map 
-    for resource in tfstate["resources"]:
-        # safety precaution
-        if len (resource["instances"]) > 1:
-            logging.critical (f"Resource {resource.get('name')} has more than 1 instance, please check")
-            exit(1)
-        # still looping over
-        for item in resource["instances"]:
-            id = item["attributes"].get('id')
-            name = normalized_tf_resource_name (item["attributes"].get('name'))
-            type = resource.get('type',"UNKNOWN TYPE")
-            all_IDs.add (id, f"{type}.{name}", type)
-
-    # device templates need to be processed first so we know which feature templates are in use
-    tf_state_devices = []
-    tf_state_rest = []
-    for resource in tfstate["resources"]:
-        if resource.get('type') in [tf_type_device_template, "sdwan_application_aware_routing_policy_definition"]:
-            if is_vedge_device (resource.get('instances',[[]])[0].get('attributes',{})):
+    return json.dumps ({resource_type: {resource["name"]: body}})
+
+def json_literal (value):
+    """ literal "${" and "%{" would start a template """
+
+    if "{" in value:
+        return value.replace ("${", "$${").replace ("%{", "%%{")
+    return value
+
+def json_value (value, res_type):
+    """ nested tfstate value -> Terraform JSON value, same as render_hcl: null dict items are dropped,
+        IDs in lists become the quoted TF name, IDs in dicts a reference (device templates: ".id" and ".version")
+    """
+
+    if type (value) == str:
+        return json_literal (id_to_name (value) or value)
+
+    if type (value) == list:
+        return [json_value (sub_value, res_type) for sub_value in value]
+
+    if type (value) == dict:
+        result = {}
+        version = None
+        for key, sub_value in value.items():
+            if sub_value is None:
                 continue
-            tf_state_devices.append (resource)
-        elif resource.get('type') == tf_type_device_cli:
-            continue
-        else:
-            tf_state_rest.append (resource)
+            if type (sub_value) != str:
+                result[key] = json_value (sub_value, res_type)
+                continue
+            name = id_to_name (sub_value)
+            # device templates: feature template reference comes with its version
+            if name and res_type == tf_type_device_template:
+                result[key] = f"${{{name}.id}}"
+                version = f"${{{name}.version}}"
+            elif name:
+                result[key] = f"${{{name}}}"
+            else:
+                result[key] = json_literal (sub_value)
+        if version:
+            result["version"] = version
+        return result
+
+    return value
+
+# -------------------------------------------------------------------------------------------------
+def write_partitions (texts, state_slices, header):
+    """ "streams" layout: data sources for objects referenced from other streams and a tfstate slice per stream """
+
+    for stream, sources in data_sources.items():
+        for name, id in sources.items():
+            [data_type, data_name] = name.split (".", 1)
+            if output_format == "json":
+                texts.add (stream, json.dumps ({data_type: {data_name: {"id": id}}}), "data")
+            else:
+                texts.add (stream, f'data "{data_type}" "{data_name}" {{\n  id = "{id}"\n}}\n')
+
+    for stream, resources in state_slices.items():
+        # same source tfstate -> same slice lineage, so an unchanged slice is byte identical
+        lineage = uuid.uuid5 (uuid.NAMESPACE_URL, f'{header["lineage"]}/{stream}') if "lineage" in header else uuid.uuid4()
+        state = {key: header[key] for key in ["version", "terraform_version"] if key in header}
+        state.update ({"serial": 1, "lineage": str (lineage), "outputs": {}})
+        text_state = mytext (texts.filename (stream, f"{tfstate_file}"), keep_unchanged=texts.keep_unchanged)
+        text_state.addraw (json.dumps (state, indent=2)[:-2] + ',\n  "resources": [\n')
+        text_state.addraw (",\n".join (resources))
+        text_state.addraw ("\n  ]\n}\n")
+        text_state.write ()
+
+# -------------------------------------------------------------------------------------------------
+def prune_unreferenced (graph, roots, rendered_ids, selected_ids, prune, report_file):
+    """ Reachability from the root objects over the ID references, returns reachable IDs
+        The unreferenced objects (out of rendered_ids, and selected_ids if any) are listed in report_file
+    """
+
+    if selected_ids is not None:
+        roots = [id for id in roots if id in selected_ids]
+        rendered_ids = [id for id in rendered_ids if id in selected_ids]
+    reachable = dependency_closure (graph, roots)
+
+    unreferenced = [{"address": all_IDs.dict[id]["name"], "id": id} for id in rendered_ids if id not in reachable]
+    counts = {}
+    for item in unreferenced:
+        tf_type = item["address"].split(".")[0]
+        counts[tf_type] = counts.get (tf_type, 0) + 1
+
+    action = "left out" if prune == "drop" else f"moved to '{prune_stream}'"
+    logging.info (f"Prune: {len (unreferenced)} of {len (rendered_ids)} objects not referenced from {len (roots)} root objects, {action}")
+    for tf_type, count in sorted (counts.items()):
+        logging.debug (f"Prune: {count} {tf_type}")
+        metrics.count ("unreferenced", tf_type, count)
+
+    try:
+        with open(report_file, "w") as file:
+            json.dump ({"prune": prune, "roots": len (roots), "objects": len (rendered_ids), "counts": counts, "unreferenced": unreferenced}, file, indent=2)
+    except OSError:
+        raise SystemExit (f"Unable to write to the '{report_file}' file, exiting...")
 
-    texts = text_handler(f"{destination_dir}{target_fname}")
-    texts.add ("main", "")
+    return reachable
 
-    # texts.add ("main", "test1")
-    # texts.add ("device", "test1")
-    # texts.add ("template", "test1")
-    # texts.write()
+# -------------------------------------------------------------------------------------------------
+def terraform_create (source_dir, destination_dir, streaming=False, layout="flat", device_templates=None, incremental=False, workers=1,
+                      prune="off", format="hcl"):
+    """ layout: "flat" - all streams in destination_dir, sharing one tfstate
+                "streams" - each stream is a separate root module in destination_dir/<stream>/ with its own tfstate slice
+        device_templates: only create the device templates matching the name patterns and the objects they reference
+        incremental: re-render only resources changed since the last run (see render_manifest), unchanged files are not rewritten
+        workers > 1: resources are rendered in a process pool (tfstates with at least render_parallel_min objects)
+        prune: objects not reachable from prune_root_types are left out ("drop") or moved to prune_stream ("split")
+        format: "hcl" or "json" (Terraform JSON syntax)
+    """
 
-    process_tfstate_file (tf_state_devices, texts)
-    process_tfstate_file (tf_state_rest, texts)
+    global all_IDs, current_partition, data_sources, pruned_ids, output_format
+
+    all_IDs = all_id_class()
+    current_partition = None
+    data_sources = {}
+    pruned_ids = set()
+    output_format = format
 
+    resources = tfstate_resources (f"{source_dir}{tfstate_file}", streaming)
+    graph = {}
+    roots = []
+    prune_roots = []
+    rendered_ids = []
+
+    try:
+        # Create ID -> Name map 
+        metrics.phase ("id_map")
+        for resource in resources ():
+            # safety precaution
+            if len (resource["instances"]) > 1:
+                logging.critical (f"Resource {resource.get('name')} has more than 1 instance, please check")
+                exit(1)
+            # still looping over
+            for item in resource["instances"]:
+                id = item["attributes"].get('id')
+                name = normalized_tf_resource_name (item["attributes"].get('name'))
+                type = resource.get('type',"UNKNOWN TYPE")
+                all_IDs.add (id, f"{type}.{name}", type)
+                metrics.count ("tf_types", type)
+
+                if device_templates or prune != "off":
+                    graph[id] = set (pattern_for_object_id.findall (json.dumps (item["attributes"]))) - {id}
+                if device_templates and type == tf_type_device_template and matches_any (item["attributes"].get('name') or "", device_templates):
+                    roots.append (id)
+                if prune != "off" and tfstate_resource_group (resource):
+                    rendered_ids.append (id)
+                # roots by type: CLI and vedge device templates are not rendered, but what they use is still referenced
+                if prune != "off" and type in prune_root_types:
+                    prune_roots.append (id)
+
+        selected_ids = dependency_closure (graph, roots) if device_templates else None
+        if device_templates:
+            logging.info (f"{len (roots)} device templates selected, {len (selected_ids)} objects in their dependency closure")
+
+        dropped_ids = []
+        if prune != "off":
+            reachable = prune_unreferenced (graph, prune_roots, rendered_ids, selected_ids, prune, f"{destination_dir}{target_fname_pruned}")
+            if prune == "drop":
+                dropped_ids = [id for id in rendered_ids if id not in reachable and (selected_ids is None or id in selected_ids)]
+                selected_ids = reachable
+            else:
+                pruned_ids = set (id for id in rendered_ids if id not in reachable)
+
+        def selected (resource, group):
+            if tfstate_resource_group (resource) != group:
+                return False
+            return selected_ids is None or resource["instances"][0]["attributes"].get('id') in selected_ids
+
+        texts = text_handler(f"{destination_dir}{target_fname}", layout, keep_unchanged=incremental, output_format=format)
+        state_slices = {} if layout == "streams" else None
+        manifest = render_manifest (f"{destination_dir}{target_fname_manifest}",
+                                    {"layout": layout, "device_templates": device_templates or [], "prune": prune, "format": format}) if incremental else None
+        if layout == "flat":
+            texts.add ("main", "")
+
+        # texts.add ("main", "test1")
+        # texts.add ("device", "test1")
+        # texts.add ("template", "test1")
+        # texts.write()
+
+        metrics.phase ("render_devices")
+        executor = None
+        if workers > 1 and len (all_IDs.dict) >= render_parallel_min:
+            executor = ProcessPoolExecutor (max_workers=workers, initializer=render_worker_init,
+                                            initargs=(all_IDs.dict, layout == "streams", pruned_ids, output_format, metrics.enabled))
+
+        # workers are stopped on errors too (SystemExit, JSON decode error)
+        try:
+            process_tfstate_file ((resource for resource in resources () if selected (resource, "devices")), texts, state_slices, manifest, executor)
+            metrics.phase ("render_rest")
+            process_tfstate_file ((resource for resource in resources () if selected (resource, "rest")), texts, state_slices, manifest, executor)
+        finally:
+            if executor:
+                executor.shutdown (cancel_futures=True)
+
+        # the flat config shares the source tfstate: without removed {} blocks TF plans to destroy the dropped objects
+        if dropped_ids and layout == "flat":
+            for id in dropped_ids:
+                address = all_IDs.dict[id]["name"]
+                if format == "json":
+                    texts.add (removed_stream, json.dumps ({"from": address, "lifecycle": {"destroy": False}}), "removed")
+                else:
+                    texts.add (removed_stream, f'removed {{\n  from = {address}\n  lifecycle {{\n    destroy = false\n  }}\n}}')
+            logging.info (f"Prune: {len (dropped_ids)} dropped objects are still in {tfstate_file}, removed {{}} blocks (TF >= 1.7) "
+                          f"written to the '{removed_stream}' stream to forget them without destroying")
+        elif dropped_ids:
+            logging.info (f"Prune: {len (dropped_ids)} dropped objects are in no module tfstate, they stay only in {source_dir}{tfstate_file}")
+
+        if layout == "streams":
+            metrics.phase ("write_partitions")
+            write_partitions (texts, state_slices, tfstate_header (f"{source_dir}{tfstate_file}"))
+
+    except json.decoder.JSONDecodeError as exception:
+        raise SystemExit (f"Unable to decode JSON in {tfstate_file} file ({exception})")
+
+    metrics.phase ("write")
     texts.write()
+    texts.remove_stale (f"{destination_dir}{target_fname_outputs}")
+
+    if manifest:
+        manifest.write ()
+        logging.info (f"Incremental create: {manifest.hits} resources unchanged, {manifest.misses} rendered")
+        metrics.count ("incremental", "unchanged", manifest.hits)
+        metrics.count ("incremental", "rendered", manifest.misses)
 
 
 # ************************************************************************************************* #
 #                                 Processing device variables                                       #
 # ************************************************************************************************* #
 # -------------------------------------------------------------------------------------------------
-def get_var_name (field):
+def get_var_name (field, quote=True):
     """ Extract var name from long GUI name """
 
     # Use value in brackets or just return a full original name
@@ -502,39 +1393,218 @@ def get_var_name (field):
     value = result.group(1) if result else field
 
     #add quotes if unsupported characters in var name...
-    if " " in value or "/" in value:
+    if quote and (" " in value or "/" in value):
         value = '"' + value + '"'
 
     return value
 
-def terraform_variables (source_dir, destination_dir, use_api):
+# -------------------------------------------------------------------------------------------------
+def variables_matrix (variables):
+    """ Device/variable matrix of one device template values file:
+        {"variables": [var names], "devices": [{"id": device id, "values": [value or null per variable]}]}
+    """
+
+    var_index = {}
+    for col in variables["header"]["columns"]:
+        var_index[col["property"]] = get_var_name (col["title"], quote=False)
+
+    # same variable order as in HCL output, null if not set for the device
+    keys = sorted (set (key for device_var in variables['data'] for key in device_var.keys() if key[:4] != "csv-"))
+    devices = [{"id": device_var.get ("csv-deviceId"), "values": [device_var.get (key) for key in keys]}
+               for device_var in variables['data']]
+
+    return {"variables": [var_index[key] for key in keys], "devices": devices}
+
+# -------------------------------------------------------------------------------------------------
+def device_chunks (template_name, variables, chunk_size=0):
+    """ Split device template values into attach resources of at most chunk_size devices, returns [(resource name, values)]
+        Devices go to one of 2^n buckets by hash of csv-deviceId, so adding or removing a device only changes its own chunk
+        (bucket count only changes when the number of devices doubles). Buckets are sized for ~50% fill so that
+        hash imbalance rarely overfills one, overfull buckets are split in file order.
+    """
+
+    devices = variables['data']
+    if chunk_size <= 0 or len (devices) <= chunk_size:
+        return [(template_name, variables)]
+
+    bucket_count = 1
+    while bucket_count * chunk_size < 2 * len (devices):
+        bucket_count *= 2
+
+    buckets = [[] for _ in range(bucket_count)]
+    for device_var in devices:
+        device_id = str (device_var.get ("csv-deviceId"))
+        buckets[int (hashlib.md5 (device_id.encode()).hexdigest()[:8], 16) % bucket_count].append (device_var)
+
+    width = len (str (bucket_count - 1))
+    chunks = []
+    for bucket_no, bucket in enumerate (buckets):
+        for sub_no, idx in enumerate (range (0, len (bucket), chunk_size)):
+            suffix = f"chunk{bucket_no:0{width}d}" if sub_no == 0 else f"chunk{bucket_no:0{width}d}_{sub_no}"
+            chunks.append ((f"{template_name}_{suffix}", {"header": variables["header"], "data": bucket[idx:idx + chunk_size]}))
+
+    return chunks
+
+# -------------------------------------------------------------------------------------------------
+def load_attach_chunks (destination_dir, var_stream, device_variables):
+    """ Attach resources of the previous run: resource name -> (device template, device IDs), from target_fname_chunks.
+        Without it, but with a previous variables file, the previous run is assumed to have one resource per template.
+    """
+
+    try:
+        with open(f"{destination_dir}{target_fname_chunks}", "r") as content_file:
+            return {name: tuple (value) for name, value in json.load (content_file).items()}, True
+    except (OSError, ValueError):
+        pass
+
+    previous_files = [f"{destination_dir}{target_fname}-{var_stream}{extension}" for extension in [".tf", ".tf.json"]]
+    if not any (os.path.exists (fname) for fname in previous_files):
+        return {}, False
+
+    previous = {}
+    for template_name, variables in device_variables.items():
+        template_name = normalized_tf_resource_name (template_name)
+        previous[template_name] = (template_name, [device_var.get ("csv-deviceId") for device_var in variables.get ("data", [])])
+    return previous, False
+
+def attach_moves (previous, attach_resources):
+    """ (from, to) names of attach resources renamed since the previous run (chunk_size changed or the number of devices
+        doubled). Without moved {} blocks TF destroys the renamed attachments, which detaches their devices.
+        Every new name takes over the previous resource of the same template sharing most devices with it.
+    """
+
+    current_names = set (resource_name for (template_name, resource_name, variables) in attach_resources)
+    candidates = {}     # template -> {previous name no longer used: device IDs}
+    for name, (template, devices) in previous.items():
+        if name not in current_names:
+            candidates.setdefault (template, {})[name] = set (devices)
+
+    moves = []
+    for (template_name, resource_name, variables) in attach_resources:
+        if resource_name in previous:
+            continue
+        devices = set (device_var.get ("csv-deviceId") for device_var in variables["data"])
+        template_candidates = candidates.get (template_name, {})
+        (overlap, name) = max (((len (devices & previous_devices), name) for name, previous_devices in template_candidates.items()), default=(0, None))
+        if overlap:
+            moves.append ((name, resource_name))
+            del template_candidates[name]
+
+    return moves
+
+# -------------------------------------------------------------------------------------------------
+def attach_resource_json (template_name, resource_name, variables, tfvars):
+    """ Attach resource in Terraform JSON syntax, same content as the HCL one """
+
+    template = f"sdwan_feature_device_template.{template_name}"
+    body = {"id": f"${{{template}.id}}", "version": f"${{{template}.version}}"}
+
+    if tfvars:
+        matrix = f'var.{tfvars_variable}["{resource_name}"]'
+        body["devices"] = (f'${{[for device in {matrix}.devices : {{ id = device.id, variables = '
+                           f'{{ for name, value in zipmap ({matrix}.variables, device.values) : name => value if value != null }} }}]}}')
+    else:
+        var_index = {col["property"]: get_var_name (col["title"], quote=False) for col in variables["header"]["columns"]}
+        body["devices"] = [{"id": device_var.get ("csv-deviceId"),
+                            "variables": {var_index[key]: str (device_var[key]).replace ("${", "$${").replace ("%{", "%%{")
+                                          for key in sorted (device_var.keys()) if key[:4] != "csv-"}}
+                           for device_var in variables['data']]
+
+    return {"sdwan_attach_feature_device_template": {resource_name: body}}
+
+# -------------------------------------------------------------------------------------------------
+def terraform_variables (source_dir, destination_dir, use_api, cache=None, tfvars=False, chunk_size=0, device_templates=None, format="hcl",
+                         layout="flat"):
+    """ tfvars: device variables go to a .auto.tfvars.json file, attach resources read them with "for" expressions
+        chunk_size: split device template devices into several attach resources, see device_chunks(). Resources renamed
+            since the previous run get moved {} blocks, see attach_moves()
+        device_templates: only device templates matching the name patterns
+        format: "hcl" or "json" (Terraform JSON syntax)
+        layout: same as create, "streams": the attach resources go to the root module of the device templates they reference
+    """
 
     json_directory = source_dir + "/device_templates/values"
     var_stream = "variables"
 
-    texts = text_handler(f"{destination_dir}{target_fname}")
+    # the module already has the header, its .auto.tfvars.json and the chunk record go there too
+    if layout == "streams":
+        destination_dir = os.path.join (destination_dir, get_stream (tf_type_device_template), "")
+        os.makedirs (destination_dir, exist_ok=True)
+
+    texts = text_handler(f"{destination_dir}{target_fname}", output_format=format)
     device_variables = {}
 
-    # if using sastre
+    # Live API data is saved in the sastre layout and processed the same way
+    if use_api:
+        metrics.phase ("fetch_api")
+        fetch_device_values (api_client (), source_dir)
+
+    metrics.phase ("load_values")
     json_files = next(os.walk(json_directory), (None, None, []))[2]
     for json_file in json_files:
-        content = load_json_file (f"{json_directory}/{json_file}")
+        if device_templates and not matches_any (json_file.split(".")[0], device_templates):
+            continue
+        json_path = f"{json_directory}/{json_file}"
+        content = cache.lookup_content (json_path) if cache else None
+        if content is None:
+            content = load_json_file (json_path)
+            if content and cache:
+                cache.store_content (json_path, content)
         if content:
             template_name = json_file.split(".")[0]
             device_variables[template_name] = content
-    # if using API...
+            metrics.count ("device_templates", "devices", len (content.get ("data", [])))
+    if cache:
+        cache.commit ()
+
+    # before the previous variables file is replaced
+    (previous_chunks, chunks_recorded) = load_attach_chunks (destination_dir, var_stream, device_variables)
 
     # start processing 123
-    
+
+    text_tfvars = mytext (f"{destination_dir}{target_fname_tfvars}")     # removes a stale file in HCL mode
+    if tfvars:
+        text_tfvars.add (f'{{"{tfvars_variable}":{{')
+        if format == "json":
+            texts.add (var_stream, json.dumps ({tfvars_variable: {"type": "any"}}), "variable")
+        else:
+            texts.add (var_stream, f'variable "{tfvars_variable}" {{ type = any }}\n')
+
+    metrics.phase ("render")
+    attach_resources = []
     for template_name, variables in device_variables.items():
+        template_name = normalized_tf_resource_name (template_name)
+        for (resource_name, chunk) in device_chunks (template_name, variables, chunk_size):
+            attach_resources.append ((template_name, resource_name, chunk))
+
+    metrics.count ("device_templates", "templates", len (device_variables))
+    metrics.count ("device_templates", "attach_resources", len (attach_resources))
+    for idx, (template_name, resource_name, variables) in enumerate (attach_resources):
+        if tfvars:
+            separator = "," if idx < len (attach_resources) - 1 else ""
+            text_tfvars.add (f'{json.dumps (resource_name)}:{json.dumps (variables_matrix (variables), separators=(",", ":"))}{separator}')
+
+        if format == "json":
+            texts.add (var_stream, json.dumps (attach_resource_json (template_name, resource_name, variables, tfvars)))
+            continue
+
+        texts.add (var_stream, f'resource "sdwan_attach_feature_device_template" "{resource_name}" {{')
+        texts.add (var_stream, f'  id = sdwan_feature_device_template.{template_name}.id')
+        texts.add (var_stream, f'  version = sdwan_feature_device_template.{template_name}.version')
+
+        if tfvars:
+            matrix = f'var.{tfvars_variable}["{resource_name}"]'
+            texts.add (var_stream, f'  devices = [for device in {matrix}.devices : {{')
+            texts.add (var_stream,  '    id = device.id')
+            texts.add (var_stream, f'    variables = {{ for name, value in zipmap ({matrix}.variables, device.values) : name => value if value != null }}')
+            texts.add (var_stream,  '  }]')
+            texts.add (var_stream,  '}')
+            continue
+
         var_index = {}
         for col in variables["header"]["columns"]:
             var_index[col["property"]] = get_var_name(col["title"])
 
-        template_name = normalized_tf_resource_name (template_name)
-        texts.add (var_stream, f'resource "sdwan_attach_feature_device_template" "{template_name}" {{')
-        texts.add (var_stream, f'  id = sdwan_feature_device_template.{template_name}.id')
-        texts.add (var_stream, f'  version = sdwan_feature_device_template.{template_name}.version')
         texts.add (var_stream, f'  devices = [')
 
         for device_var in variables['data']:
@@ -551,9 +1621,189 @@ def terraform_variables (source_dir, destination_dir, use_api):
         texts.add (var_stream,  '  ]')
         texts.add (var_stream,  '}')
 
+    moves = attach_moves (previous_chunks, attach_resources)
+    for (from_name, to_name) in moves:
+        (from_address, to_address) = (f"sdwan_attach_feature_device_template.{from_name}", f"sdwan_attach_feature_device_template.{to_name}")
+        if format == "json":
+            texts.add (var_stream, json.dumps ({"from": from_address, "to": to_address}), "moved")
+        else:
+            texts.add (var_stream, f'moved {{\n  from = {from_address}\n  to   = {to_address}\n}}')
+    if moves:
+        logging.info (f"{len (moves)} attach resources renamed since the previous run, moved {{}} blocks added to keep the devices attached")
+
+    metrics.phase ("write")
+    # the previous names are only known from the record, it is kept once chunking was used
+    if chunk_size > 0 or chunks_recorded:
+        chunks = {resource_name: (template_name, [device_var.get ("csv-deviceId") for device_var in variables["data"]])
+                  for (template_name, resource_name, variables) in attach_resources}
+        with open(f"{destination_dir}{target_fname_chunks}.tmp", "w") as file:
+            json.dump (chunks, file, indent=2)
+        os.replace (f"{destination_dir}{target_fname_chunks}.tmp", f"{destination_dir}{target_fname_chunks}")
+
+    if tfvars:
+        text_tfvars.add ("}}")
+        text_tfvars.write()
+
     texts.write()
 
 # ==============================================================================================
+def load_env_file (env_file):
+    """ KEY=VALUE lines, blank lines and # comments are skipped, values may be quoted """
+
+    environment = {}
+    try:
+        with open(env_file, "r") as content_file:
+            for number, line in enumerate (content_file, 1):
+                line = line.strip ()
+                if not line or line.startswith ("#"):
+                    continue
+                (key, separator, value) = line.partition ("=")
+                if not separator:
+                    raise ValueError (f"no '=' on line {number}")
+                value = value.strip ()
+                if len (value) > 1 and value[0] == value[-1] and value[0] in "\"'":
+                    value = value[1:-1]
+                environment[key.strip ()] = value
+    except (OSError, ValueError) as exception:
+        raise SystemExit (f"Unable to read env file '{env_file}' ({exception}), exiting...")
+
+    return environment
+
+def load_batch_manifest (manifest_file):
+    """ JSON list of jobs {"source_dir", "destination_dir", "name" (optional), any batch_defaults key (optional),
+        "env_file" and batch_credentials keys (optional)}. Relative paths are relative to the manifest file
+    """
+
+    try:
+        with open(manifest_file, "r") as content_file:
+            entries = json.load (content_file)
+    except (OSError, ValueError) as exception:
+        raise SystemExit (f"Unable to read batch manifest '{manifest_file}' ({exception}), exiting...")
+
+    base_dir = os.path.dirname (os.path.abspath (manifest_file))
+    jobs = []
+    for idx, entry in enumerate (entries if type (entries) == list else []):
+        unknown = set (entry.keys()) - set (batch_defaults.keys()) - set (batch_credentials.keys()) - {"name", "source_dir", "destination_dir", "env_file"}
+        if not entry.get ("source_dir") or not entry.get ("destination_dir") or unknown:
+            raise SystemExit (f"Batch manifest '{manifest_file}' entry {idx}: source_dir and destination_dir are required"
+                              f"{f', unknown keys {sorted (unknown)}' if unknown else ''}, exiting...")
+
+        job = {**batch_defaults, **entry}
+        for key in ["source_dir", "destination_dir"]:
+            job[key] = os.path.join (os.path.normpath (os.path.join (base_dir, job[key])), "")
+        job["name"] = job.get ("name") or os.path.basename (os.path.dirname (job["destination_dir"]))
+        job["environment"] = load_env_file (os.path.join (base_dir, job["env_file"])) if job.get ("env_file") else {}
+        for key, variable in batch_credentials.items():
+            if job.get (key):
+                job["environment"][variable] = job[key]
+        jobs.append (job)
+
+    if not jobs:
+        raise SystemExit (f"No jobs in batch manifest '{manifest_file}', exiting...")
+    if len (set (job["destination_dir"] for job in jobs)) < len (jobs):
+        raise SystemExit (f"Batch manifest '{manifest_file}': every job needs its own destination_dir, exiting...")
+
+    return jobs
+
+# -------------------------------------------------------------------------------------------------
+def batch_job (job, cache_file, lock_file, plugin_dir=None, metrics_enabled=False):
+    """ One backup: import in <destination_dir>/import/ (the TF working directory with terraform.tfstate), create and vars
+        to destination_dir. Runs in a fresh process (module state, working directory, environment and metrics are per job).
+        Returns {"name", "error", "actions": {action: metrics report}}
+    """
+
+    global init_lock
+
+    logging.basicConfig(format=f'{job["name"]}: %(levelname)s: %(message)s', level=logging.DEBUG)
+    init_lock = lock_file
+    metrics.enabled = metrics_enabled
+    # provider credentials of the job's vManage, for terraform and --api
+    os.environ.update (job["environment"])
+    cache = inventory_cache (cache_file) if cache_file else None
+
+    work_dir = os.path.join (job["destination_dir"], batch_import_dir, "")
+    os.makedirs (work_dir, exist_ok=True)
+    os.chdir (work_dir)
+
+    result = {"name": job["name"], "error": None, "actions": {}}
+    for action in job["actions"]:
+        metrics.action = action
+        metrics.reset ()
+        try:
+            if action == "import":
+                terraform_import (job["source_dir"], work_dir, False, import_mode=job["mode"], workers=job["workers"], cache=cache,
+                                  device_templates=job["device_template"], offline=job["offline"], plugin_dir=plugin_dir)
+            elif action == "create":
+                terraform_create (work_dir, job["destination_dir"], layout=job["layout"], device_templates=job["device_template"],
+                                  workers=job["workers"], prune=job["prune"], format=job["format"])
+            elif action == "vars":
+                terraform_variables (job["source_dir"], job["destination_dir"], False, cache=cache, tfvars=job["tfvars"],
+                                     device_templates=job["device_template"], format=job["format"], layout=job["layout"])
+            else:
+                raise SystemExit (f"Unknown batch action '{action}'")
+        except SystemExit as exception:
+            # exit(1) after the error was logged has no message
+            result["error"] = f"{action}: {exception.code if type (exception.code) == str else 'failed'}"
+        except Exception as exception:
+            # the other jobs go on
+            logging.exception (f"{action} failed")
+            result["error"] = f"{action}: {exception!r}"
+        metrics.phase (None)
+        result["actions"][action] = metrics.report ()
+        if result["error"]:
+            break
+
+    if cache:
+        cache.close ()
+    return result
+
+def terraform_batch (manifest_file, jobs, cache_file, plugin_cache, plugin_dir=None, break_lock=False):
+    """ Backups of a manifest processed by a pool of jobs processes, sharing the TF plugin cache and the sastre inventory cache """
+
+    # a job changes its process' working directory, environment and module state: one process per job
+    if sys.version_info < (3, 11):
+        raise SystemExit ("batch needs Python 3.11 or later (ProcessPoolExecutor max_tasks_per_child), exiting...")
+
+    metrics.phase ("load_manifest")
+    batch_jobs = load_batch_manifest (manifest_file)
+
+    # the provider is downloaded once for all the jobs, their "terraform init" runs one at a time (init_lock)
+    plugin_cache = use_plugin_cache (plugin_cache, break_lock)
+    lock_file = os.path.join (plugin_cache, ".init.lock")
+    if cache_file:
+        cache_file = os.path.abspath (cache_file)
+    if plugin_dir:
+        plugin_dir = os.path.abspath (plugin_dir)
+
+    metrics.phase ("run_jobs")
+    logging.info (f"Batch: {len (batch_jobs)} jobs, {min (jobs, len (batch_jobs))} at a time, plugin cache {plugin_cache}")
+    with ProcessPoolExecutor (max_workers=min (jobs, len (batch_jobs)), mp_context=multiprocessing.get_context ("spawn"),
+                              max_tasks_per_child=1) as executor:
+        for job, result in zip (batch_jobs, executor.map (batch_job, batch_jobs, repeat (cache_file), repeat (lock_file), repeat (plugin_dir),
+                                                                repeat (metrics.enabled))):
+            metrics.job (result)
+            if result["error"]:
+                logging.error (f'Batch job {job["name"]} ({job["source_dir"]}) failed: {result["error"]}')
+            else:
+                logging.info (f'Batch job {job["name"]} done')
+
+    failed = [job for job in metrics.jobs if job["error"]]
+    if failed:
+        raise SystemExit (f"{len (failed)} of {len (batch_jobs)} batch jobs failed: {', '.join (job['name'] for job in failed)}")
+
+# ==============================================================================================
+def non_negative_int (value):
+    number = int (value)
+    if number < 0:
+        raise argparse.ArgumentTypeError (f"{value} is negative")
+    return number
+
+def positive_int (value):
+    number = int (value)
+    if number < 1:
+        raise argparse.ArgumentTypeError (f"{value} is not a positive number")
+    return number
+
 def main():
     logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG)
 
@@ -566,43 +1816,128 @@ def main():
 
     subparsers = parser.add_subparsers(dest='action', help = "Action to perform")
     import_parser = subparsers.add_parser('import', help = "Process SD-WAN data and import from Terraform into terraform.tfstate")
-    import_parser.add_argument('-a', '--api', action='store_true', help="Do live API calls instead of using sastre backup")
+    import_parser.add_argument('-a', '--api', action='store_true', help="Do live API calls instead of using sastre backup, data is saved to source_dir (credentials: TF_VAR_MANAGER_ADDR/USER/PASS)")
     import_parser.add_argument('-s', '--source_dir', default = "./data", help="Directory with the sastre backup files")
     import_parser.add_argument('-d', '--destination_dir', default = "./", help="Directory to store Terraform.tfstate file")
+    import_parser.add_argument('--device_template', action='append', metavar='NAME',
+                               help="Only process this device template and the objects it uses (repeatable, globs allowed)")
+    import_parser.add_argument('-m', '--mode', choices=['script', 'blocks'], default = "script", 
+                               help="'script': one 'terraform import' per object (fallback), 'blocks': single plan/apply with import {} blocks (TF >= 1.5)")
+    import_parser.add_argument('-i', '--incremental', action='store_true', help="Keep terraform.tfstate, import only new objects and remove the ones no longer in the backup")
+    import_parser.add_argument('-w', '--workers', type=int, default = 1, help="Number of processes loading the sastre inventory (default: 1, in process)")
+    import_parser.add_argument('-c', '--cache', default = None, help="Cache file for parsed sastre files, reused while the files don't change")
+    import_parser.add_argument('-j', '--jobs', type=positive_int, default = 1, help="Number of parallel import shards in 'script' mode (default: 1, run the bash script)")
+    import_parser.add_argument('-r', '--restart', action='store_true', help=f"Discard the journal of an unfinished import ({target_fname_journal}) and start over")
+    import_parser.add_argument('-u', '--upgrade', action='store_true', help="Always run 'terraform init -upgrade', even if the installed provider satisfies the required version")
+    import_parser.add_argument('--plugin_cache', metavar='DIR', default = None, help="Terraform provider plugin cache directory (TF_PLUGIN_CACHE_DIR), shared by runs")
+    import_parser.add_argument('--plugin_cache_break_lock', action='store_true',
+                               help="Set TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE, so the plugin cache is used without a lock file (TF >= 1.4)")
+    import_parser.add_argument('--plugin_dir', metavar='DIR', default = None, help="Install the provider from this filesystem mirror instead of the registry (air-gapped)")
+    import_parser.add_argument('-o', '--offline', action='store_true', help=f"Write tfstate of the supported object types (policy lists) which passed --schema_check ({target_fname_schema}) straight from the sastre backup, 'terraform import' only the rest")
+    import_parser.add_argument('--schema_check', metavar='TFSTATE', default = None,
+                               help=f"Compare the offline tfstate with TFSTATE from a real import, report to {target_fname_schema}, nothing is imported")
+    import_parser.add_argument('--metrics', metavar='FILE', default = None, help="Write phase timing, memory, object counts and terraform command timing as JSON to FILE")
+    import_parser.add_argument('--profile', metavar='PREFIX', default = None, help="Profile the run with cProfile and tracemalloc, output to PREFIX.prof and PREFIX.txt")
 
     create_parser = subparsers.add_parser('create', help="Process previously created terraform.tfstate and create Terraform resources")
     create_parser.add_argument('-s', '--source_dir', default = "./", help="Directory with the source terraform.tfstate file")
     create_parser.add_argument('-d', '--destination_dir', default = "./", help="Directory to store target Terraform configuration files")
+    create_parser.add_argument('--device_template', action='append', metavar='NAME',
+                               help="Only process this device template and the objects it uses (repeatable, globs allowed)")
+    create_parser.add_argument('-l', '--layout', choices=['flat', 'streams'], default = "flat",
+                               help="'flat': one Terraform configuration, 'streams': a root module with its own tfstate per stream (feature_template, policy_object, ...)")
+    create_parser.add_argument('-i', '--incremental', action='store_true',
+                               help=f"Re-render only resources changed since the last run ({target_fname_manifest}), leave unchanged files untouched")
+    create_parser.add_argument('-w', '--workers', type=int, default = 1, help="Number of processes rendering the resources (default: 1, in process; pays off only on large tfstates)")
+    create_parser.add_argument('-p', '--prune', choices=['off', 'drop', 'split'], default = "off",
+                               help=f"Objects not used by any device template, centralized or security policy: 'drop' them (flat layout: removed {{}} blocks in the '{removed_stream}' stream, TF >= 1.7) or 'split' them to the '{prune_stream}' stream, listed in {target_fname_pruned}")
+    create_parser.add_argument('-f', '--format', choices=['hcl', 'json'], default = "hcl", help="Output HCL (.tf) or Terraform JSON syntax (.tf.json)")
+    create_parser.add_argument('--streaming', action='store_true', help="Stream-parse terraform.tfstate in several passes instead of loading it whole")
+    create_parser.add_argument('--metrics', metavar='FILE', default = None, help="Write phase timing, memory, object counts and terraform command timing as JSON to FILE")
+    create_parser.add_argument('--profile', metavar='PREFIX', default = None, help="Profile the run with cProfile and tracemalloc, output to PREFIX.prof and PREFIX.txt")
 
     vars_parser = subparsers.add_parser('vars', help="Process SD-WAN data and create Terraform device variables resources")
-    vars_parser.add_argument('-a', '--api', action='store_true', help="Do live API calls instead of using sastre backup")
+    vars_parser.add_argument('-a', '--api', action='store_true', help="Do live API calls instead of using sastre backup, data is saved to source_dir (credentials: TF_VAR_MANAGER_ADDR/USER/PASS)")
     vars_parser.add_argument('-s', '--source_dir', default = "./data", help="Directory with the sastre backup files")
     vars_parser.add_argument('-d', '--destination_dir', default = "./", help="Directory to store target Terraform configuration file")
+    vars_parser.add_argument('--device_template', action='append', metavar='NAME',
+                               help="Only process this device template and the objects it uses (repeatable, globs allowed)")
+    vars_parser.add_argument('-t', '--tfvars', action='store_true', help=f"Write device variables to {target_fname_tfvars} instead of inline HCL")
+    vars_parser.add_argument('-n', '--chunk_size', type=non_negative_int, default = 0,
+                             help=f"Max number of devices per attach resource (default: 0, one resource per device template), renamed resources get moved {{}} blocks (devices of the previous run in {target_fname_chunks})")
+    vars_parser.add_argument('-l', '--layout', choices=['flat', 'streams'], default = "flat",
+                             help="Same as create: 'streams' writes the attach resources into the device_template root module")
+    vars_parser.add_argument('-f', '--format', choices=['hcl', 'json'], default = "hcl", help="Output HCL (.tf) or Terraform JSON syntax (.tf.json)")
+    vars_parser.add_argument('-c', '--cache', default = None, help="Cache file for parsed sastre files, reused while the files don't change")
+    vars_parser.add_argument('--metrics', metavar='FILE', default = None, help="Write phase timing, memory, object counts and terraform command timing as JSON to FILE")
+    vars_parser.add_argument('--profile', metavar='PREFIX', default = None, help="Profile the run with cProfile and tracemalloc, output to PREFIX.prof and PREFIX.txt")
+
+    batch_parser = subparsers.add_parser('batch', help="Run import, create and vars for many sastre backups listed in a manifest, several at a time (Python 3.11+)")
+    batch_parser.add_argument('manifest', help=f"JSON list of {{\"source_dir\", \"destination_dir\"}} jobs, optionally with a \"name\", overrides of {sorted (batch_defaults.keys())} "
+                                              f"and the job's credentials: \"env_file\" (KEY=VALUE lines) and/or {sorted (batch_credentials.keys())}")
+    batch_parser.add_argument('-j', '--jobs', type=positive_int, default = os.cpu_count(), help="Number of backups processed at the same time (default: number of CPUs)")
+    batch_parser.add_argument('-c', '--cache', default = None, help="Cache file for parsed sastre files, shared by the jobs")
+    batch_parser.add_argument('--plugin_cache', default = os.environ.get ("TF_PLUGIN_CACHE_DIR", ".terraform-plugin-cache"),
+                              help="Terraform provider plugin cache directory shared by the jobs (default: TF_PLUGIN_CACHE_DIR or .terraform-plugin-cache)")
+    batch_parser.add_argument('--plugin_cache_break_lock', action='store_true',
+                              help="Set TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE, so the jobs use the plugin cache without a lock file (TF >= 1.4)")
+    batch_parser.add_argument('--plugin_dir', metavar='DIR', default = None, help="Install the provider from this filesystem mirror instead of the registry (air-gapped)")
+    batch_parser.add_argument('--metrics', metavar='FILE', default = None, help="Write the combined metrics of all jobs (and each job's report) as JSON to FILE")
 
     args = parser.parse_args(None if sys.argv[1:] else ['-h'])
 
     action = args.action
 
-    source_dir = "./" if args.source_dir == "" else args.source_dir
+    source_dir = "./" if getattr (args, "source_dir", "") == "" else args.source_dir
     if source_dir [-1] != '/':
         source_dir += '/'
 
-    destination_dir = "./" if args.destination_dir == "" else args.destination_dir
+    destination_dir = "./" if getattr (args, "destination_dir", "") == "" else args.destination_dir
     if destination_dir [-1] != '/':
         destination_dir += '/'
 
 
-    if action == "import":
-        print ("Doing import")
-        terraform_import (source_dir, destination_dir, args.api)
-    elif action == "create":
-        print ("Doing create")
-        terraform_create (source_dir, destination_dir)
-    elif action == "vars":
-        print ("Doing vars")
-        terraform_variables (source_dir, destination_dir, args.api)
-    else:
-        print ("Should not be here!")
+    # batch jobs open the cache themselves
+    cache = inventory_cache (args.cache) if getattr (args, "cache", None) and action != "batch" else None
+
+    metrics.enabled = bool (getattr (args, "metrics", None))
+    metrics.action = action
+    profiler = run_profiler (args.profile) if getattr (args, "profile", None) else None
+    if profiler:
+        profiler.start ()
+
+    # metrics are also written when the run fails half way
+    try:
+        if action == "import":
+            print ("Doing import")
+            if args.plugin_cache:
+                use_plugin_cache (args.plugin_cache, args.plugin_cache_break_lock)
+            terraform_import (source_dir, destination_dir, args.api, import_mode=args.mode, jobs=args.jobs, incremental=args.incremental,
+                              workers=args.workers, cache=cache, device_templates=args.device_template, offline=args.offline,
+                              schema_check=args.schema_check, restart=args.restart, upgrade=args.upgrade, plugin_dir=args.plugin_dir)
+        elif action == "create":
+            print ("Doing create")
+            terraform_create (source_dir, destination_dir, streaming=args.streaming, layout=args.layout, device_templates=args.device_template,
+                              incremental=args.incremental, workers=args.workers, prune=args.prune, format=args.format)
+        elif action == "vars":
+            print ("Doing vars")
+            terraform_variables (source_dir, destination_dir, args.api, cache=cache, tfvars=args.tfvars, chunk_size=args.chunk_size,
+                                 device_templates=args.device_template, format=args.format, layout=args.layout)
+        elif action == "batch":
+            print ("Doing batch")
+            terraform_batch (args.manifest, args.jobs, args.cache, args.plugin_cache, plugin_dir=args.plugin_dir,
+                             break_lock=args.plugin_cache_break_lock)
+        else:
+            print ("Should not be here!")
+    finally:
+        metrics.phase (None)
+        if profiler:
+            profiler.stop ()
+        if metrics.enabled:
+            metrics.write (args.metrics)
+
+    if cache:
+        cache.close ()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,159 @@
+import os, re, json, uuid, logging
+
+# Offline tfstate: provider state built from the sastre detail files, no "terraform import" (and no API read) per object
+#   Only TF types with a mapper below are synthesized, everything else still goes through "terraform import".
+#   Mappers follow the provider attribute schema, check_schema_coverage() compares them with a real imported tfstate.
+#   Only TF types with a passing coverage report (verified_types) are synthesized, the others are imported as usual.
+
+provider_address = 'provider["registry.terraform.io/ciscodevnet/sdwan"]'
+state_terraform_version = "1.0.0"     # TF upgrades older state silently, but refuses state written by a newer version
+
+# sastre camelCase keys where the provider attribute is not just the snake_case form
+attribute_overrides = {
+    "app": "application",
+    "appFamily": "application_family",
+    "ipPrefix": "prefix",
+    "vpn": "vpn_id",
+    "tloc": "tloc_ip",
+    "encap": "encapsulation",
+}
+
+int_attributes = ["ge", "le", "preference"]     # strings in sastre, numbers in the provider schema
+
+# -------------------------------------------------------------------------------------------------
+def attribute_name (key):
+    return attribute_overrides.get (key) or re.sub (r'(?<!^)(?=[A-Z])', '_', key).lower()
+
+def map_entry (entry):
+    attributes = {}
+    for key, value in entry.items():
+        key = attribute_name (key)
+        if key in int_attributes and type (value) == str and value.isdigit():
+            value = int (value)
+        attributes[key] = value
+    return attributes
+
+def policy_list_attributes (name, content):
+    return {"id": content.get ("listId"), "name": name, "version": 0,
+            "entries": [map_entry (entry) for entry in content.get ("entries", [])]}
+
+# TF type -> mapper (TF name, sastre detail content) -> attributes
+state_mappers = {
+    "sdwan_application_list_policy_object": policy_list_attributes,
+    "sdwan_color_list_policy_object": policy_list_attributes,
+    "sdwan_data_fqdn_prefix_list_policy_object": policy_list_attributes,
+    "sdwan_data_ipv4_prefix_list_policy_object": policy_list_attributes,
+    "sdwan_ipv4_prefix_list_policy_object": policy_list_attributes,
+    "sdwan_local_application_list_policy_object": policy_list_attributes,
+    "sdwan_port_list_policy_object": policy_list_attributes,
+    "sdwan_protocol_list_policy_object": policy_list_attributes,
+    "sdwan_site_list_policy_object": policy_list_attributes,
+    "sdwan_tloc_list_policy_object": policy_list_attributes,
+    "sdwan_vpn_list_policy_object": policy_list_attributes,
+    "sdwan_zone_list_policy_object": policy_list_attributes,
+}
+
+# -------------------------------------------------------------------------------------------------
+def synthesize_resources (import_items, details, tf_types=None):
+    """ import_items: [(TF address, ID)], details: ID -> sastre detail content, tf_types: only these TF types (None: all mapped)
+        Returns (tfstate resources, [(TF address, ID)] left for "terraform import")
+    """
+
+    resources = []
+    remaining = []
+    for (object_address, object_id) in import_items:
+        [object_type, object_name] = object_address.split(".", 1)
+        mapper = state_mappers.get (object_type) if tf_types is None or object_type in tf_types else None
+        content = details.get (object_id)
+        if not mapper or content is None:
+            remaining.append ((object_address, object_id))
+            continue
+
+        resources.append ({"mode": "managed", "type": object_type, "name": object_name, "provider": provider_address,
+                           "instances": [{"schema_version": 0, "attributes": mapper (object_name, content), "sensitive_attributes": []}]})
+
+    return (resources, remaining)
+
+# -------------------------------------------------------------------------------------------------
+def write_tfstate (resources, filename):
+    state = {"version": 4, "terraform_version": state_terraform_version, "serial": 1, "lineage": str (uuid.uuid4()),
+             "outputs": {}, "resources": resources, "check_results": None}
+
+    temp_file = f"{filename}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump (state, file, indent=2)
+    os.replace (temp_file, filename)
+
+# -------------------------------------------------------------------------------------------------
+def attribute_paths (value, prefix=""):
+    """ Flatten attributes to {"entries.0.site_id": value}, null values are left out (same as not set) """
+
+    if type (value) == dict:
+        items = value.items()
+    elif type (value) == list:
+        items = enumerate (value)
+    else:
+        return {} if value is None else {prefix: value}
+
+    paths = {}
+    for key, item in items:
+        paths.update (attribute_paths (item, f"{prefix}.{key}" if prefix else str (key)))
+    return paths
+
+def check_schema_coverage (resources, tfstate_file):
+    """ Compare synthesized resources with the same objects (by ID) in a tfstate produced by a real import
+        Returns {TF type: {"objects", "compared", "matched", "missing", "extra", "different"}}, attribute paths with list indexes removed
+    """
+
+    try:
+        with open(tfstate_file, "r") as content_file:
+            real_state = json.load (content_file)
+    except (OSError, ValueError) as exception:
+        raise SystemExit (f"Unable to load tfstate '{tfstate_file}' for the schema check ({exception}), exiting...")
+
+    real_attributes = {}
+    for resource in real_state.get ("resources", []):
+        for item in resource["instances"]:
+            real_attributes[item["attributes"].get ("id")] = item["attributes"]
+
+    report = {}
+    for resource in resources:
+        attributes = resource["instances"][0]["attributes"]
+        type_report = report.setdefault (resource["type"], {"objects": 0, "compared": 0, "matched": 0, "missing": set(), "extra": set(), "different": set()})
+        type_report["objects"] += 1
+        real = real_attributes.get (attributes.get ("id"))
+        if real is None:
+            continue
+
+        type_report["compared"] += 1
+        synthesized = attribute_paths (attributes)
+        real = attribute_paths (real)
+        generic = lambda path: re.sub (r'\.\d+', '[]', path)
+        type_report["missing"].update (generic (path) for path in real.keys() - synthesized.keys())
+        type_report["extra"].update (generic (path) for path in synthesized.keys() - real.keys())
+        different = [path for path in synthesized.keys() & real.keys() if synthesized[path] != real[path]]
+        type_report["different"].update (generic (path) for path in different)
+        if synthesized == real:
+            type_report["matched"] += 1
+
+    for tf_type, type_report in sorted (report.items()):
+        for key in ["missing", "extra", "different"]:
+            type_report[key] = sorted (type_report[key])
+        log = logging.info if type_report["matched"] == type_report["compared"] else logging.warning
+        log (f"Schema coverage {tf_type}: {type_report['matched']} of {type_report['compared']} compared objects identical"
+             f" ({type_report['objects']} synthesized), missing {type_report['missing']}, extra {type_report['extra']},"
+             f" different {type_report['different']}")
+
+    return report
+
+def verified_types (report_file):
+    """ TF types of a check_schema_coverage report with at least one compared object and all compared objects identical """
+
+    try:
+        with open(report_file, "r") as content_file:
+            report = json.load (content_file)
+    except (OSError, ValueError):
+        return set()
+
+    return set (tf_type for tf_type, type_report in report.items()
+                if tf_type in state_mappers and type_report.get ("compared") and type_report.get ("matched") == type_report.get ("compared"))